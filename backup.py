@@ -13,9 +13,16 @@ The target is essentially a copy of the source, except that:
 
 Some state files are maintained in the base target dir:
   - journal for the state of the NTFS journal from the last
-  backup, including a dir map.
+  backup, including a dir map (one per source, e.g. journal-C, when
+  backing up several sources).
   - previous for the previous successful backup name
   - exclusions is a list of files and dirs to exclude from backups.
+  - stats has the throughput measured in the last backup, for
+  estimates.
+  - blocks has the block hashes of large files, for delta updates
+  (if enabled).
+  - packs is a directory of pack files holding small files, and a
+  catalog of the packed files in each backup (if packing is enabled).
 
 Basic algorithm:
   - Input is source directory, target directory, and name.
@@ -25,21 +32,34 @@ Basic algorithm:
      - For each file/dir, either copy in or make link to copy in previous
        backup.
   - Save journal file.
+
+Several sources can be backed up at once, each into a subtree of the
+backup named after its drive letter or last path component (e.g.
+C:/snapshots/20101103/C and C:/snapshots/20101103/D).  Sources on
+different devices are backed up concurrently.  They share the manifest,
+so contents found on one can be reused on another.
   
 Example:
 
 backup.py C:/ C:/snapshots 20101103
+backup.py -n 20101103 C:/ D:/ C:/snapshots
 """
 
 import sys
 import os
 import os.path
 import cPickle
-import hashlib
 import time
+import bisect
+import threading
 from optparse import OptionParser
 
 import links
+import packs
+import cacheio
+import hashes
+import exclusions
+import sparse
 
 
 BUFFER_SIZE = 1024*1024
@@ -49,6 +69,14 @@ JOURNAL_FILENAME = "journal"
 PREVIOUS_FILENAME = "previous"
 EXCLUSIONS_FILENAME = "exclusions"
 MANIFEST_FILENAME = "manifest"
+MANIFEST_VERSION = 2
+BLOCKS_FILENAME = "blocks"
+STATS_FILENAME = "stats"
+
+DELTA_BLOCK_SIZE = 1024*1024
+
+NTFS_LINK_LIMIT = 1024
+LINK_LIMIT_MARGIN = 8
 
 ALLOW_JOURNAL = True
 
@@ -56,6 +84,7 @@ if ALLOW_JOURNAL:
     try:
         import journal
         from journal import Journal
+        ALLOW_JOURNAL = journal.is_available()
     except ImportError:
         ALLOW_JOURNAL = False
 
@@ -76,16 +105,73 @@ class ConsoleNotifier(object):
     def __init__(self, parent):
         self.parent = parent
 
+    # Each message is written in one call, so that those from concurrent
+    # sources aren't interleaved.
     def notice(self, msg):
-        print >>sys.stderr, msg
+        sys.stderr.write('%s\n' % msg)
     
     def warning(self, msg):
-        print >>sys.stderr, 'Warning: %s' % msg
+        sys.stderr.write('Warning: %s\n' % msg)
     
     def error(self, msg, ex=None):
-        print >>sys.stderr, 'Error: %s' % msg
         if ex is not None:
-            print >>sys.stderr, 'Exception was:', ex
+            sys.stderr.write('Error: %s\nException was: %s\n' % (msg, ex))
+        else:
+            sys.stderr.write('Error: %s\n' % msg)
+
+
+class PrefixNotifier(object):
+    """Passes messages on to another notifier, prefixed with the name of
+    the source they are about."""
+
+    def __init__(self, notifier, prefix):
+        self.notifier = notifier
+        self.prefix = prefix
+
+    def notice(self, msg):
+        self.notifier.notice('%s: %s' % (self.prefix, msg))
+    
+    def warning(self, msg):
+        self.notifier.warning('%s: %s' % (self.prefix, msg))
+    
+    def error(self, msg, ex=None):
+        self.notifier.error('%s: %s' % (self.prefix, msg), ex)
+
+
+def get_source_name(source):
+    """The name of the subtree a source is backed up into, when backing up
+    several: its last path component, or failing that its drive letter."""
+    drive, path = os.path.splitdrive(source)
+    name = os.path.basename(os.path.normpath(path))
+    if name == '.':
+        name = ''
+    if name == '':
+        name = drive.rstrip(':')
+    return name
+
+
+def get_device(path):
+    """Identify the device a path is on.  Python 2 gives no st_dev on
+    Windows, so the drive letter is used there."""
+    drive = os.path.splitdrive(os.path.abspath(path))[0]
+    if drive != '':
+        return drive.upper()
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return path
+
+
+def split_paths(d, name):
+    """The entries of a dict keyed by item path that are in the named
+    subtree, keyed relative to it."""
+    prefix = os.path.join(name, '')
+    return dict((path[len(prefix):], value) for path, value in d.iteritems() if path.startswith(prefix))
+
+
+def join_paths(d, name):
+    """The reverse of split_paths."""
+    return dict((os.path.join(name, path), value) for path, value in d.iteritems())
 
 
 class Backup(object):
@@ -97,20 +183,58 @@ class Backup(object):
         self.source = None
         self.target = None
         self.enable_journal = False
+        self.journal_filename = JOURNAL_FILENAME
         self.enable_dir_reuse = False
+        self.enable_fast_reuse = False
+        self.pack_threshold = None
+        self.cache_neutral = False
+        self.hash_algorithm = hashes.DEFAULT_ALGORITHM
+        self.manifest = {}
+        self.legacy_manifests = {}
+        self.delta_min_size = None
+        self.block_hashes = {}
+        self.lock = threading.Lock()
+        self.link_limit = None
+        self.clear_stats()
     
-    def get_md5(self, source_path):
-        f = open(source_path, 'rb')
+    def clear_stats(self):
+        self.items = 0
+        self.read_bytes = 0
+        self.read_time = 0.0
+        self.elapsed = 0.0
+    
+    def open_source(self, source_path):
+        if not self.cache_neutral:
+            return open(source_path, 'rb')
+        direct = os.path.getsize(source_path) >= cacheio.DIRECT_MIN_SIZE
+        return cacheio.CacheNeutralReader(source_path, direct)
+    
+    def open_dest(self, dest_path):
+        if not self.cache_neutral:
+            return open(dest_path, 'wb')
+        return cacheio.CacheNeutralWriter(dest_path)
+    
+    def get_hash(self, source_path, blocks=None, extents=None):
+        """Hash the file with the current algorithm, and those of any legacy
+        manifests (and its blocks, if a BlockHashes is given).  If the file's
+        data extents are given, its holes are hashed without being read.
+        Returns the digests, the size, and the file contents if they were
+        small enough to keep."""
+        f = self.open_source(source_path)
+        if extents is not None:
+            f = sparse.SparseReader(f, extents, os.path.getsize(source_path))
         big_buf = []
-        m = hashlib.md5()
+        m = hashes.MultiHash([self.hash_algorithm] + self.legacy_manifests.keys())
         total = 0
         while len(big_buf) < MAX_BUFFERS:
             buf = f.read(BUFFER_SIZE)
             if len(buf) == 0:
                 f.close()
-                return m.hexdigest(), total, big_buf
+                return m.hexdigests(), total, big_buf
             total += len(buf)
             m.update(buf)
+            if blocks is not None:
+                blocks.update(buf)
             big_buf.append(buf)
         big_buf = None
         while True:
@@ -119,27 +243,59 @@ class Backup(object):
                 break
             total += len(buf)
             m.update(buf)           
+            if blocks is not None:
+                blocks.update(buf)
         f.close()
-        return m.hexdigest(), total, big_buf
+        return m.hexdigests(), total, big_buf
+    
+    def migrate_from_legacy(self, digests):
+        """Move any legacy manifest entries for these contents into the
+        current manifest."""
+        key = digests[self.hash_algorithm]
+        for algorithm, manifest in self.legacy_manifests.iteritems():
+            legacy_key = digests[algorithm]
+            if legacy_key in manifest:
+                self.manifest.setdefault(key, []).extend(manifest.pop(legacy_key))
     
-    def reuse_from_manifest(self, md5, size, item_path):
+    def get_link_limit(self):
+        """The most hard links a file in the target can have, less a margin
+        for links made without checking (e.g. when reusing from the journal)."""
+        if self.link_limit is None:
+            try:
+                limit = os.pathconf(self.target, 'PC_LINK_MAX')
+            except (AttributeError, ValueError, OSError):
+                limit = NTFS_LINK_LIMIT
+            self.link_limit = limit - LINK_LIMIT_MARGIN
+        return self.link_limit
+    
+    def reuse_from_manifest(self, digests, size, item_path):
+        """Link the item to a stored copy of the same contents, if there is
+        one.  A copy whose file is near the link limit is passed over (and
+        only one path to it kept in the manifest); if they all are, the item
+        is copied, and becomes the replica the next items are linked to."""
         if size == 0:
             return False
         
+        key = digests[self.hash_algorithm]
+        if key not in self.manifest:
+            self.migrate_from_legacy(digests)
+        
         new_path = os.path.join(self.name, item_path)
-        if md5 not in self.manifest:
-            self.manifest[md5] = [new_path]
+        if key not in self.manifest:
+            self.manifest[key] = [new_path]
             return False
         
-        l = self.manifest[md5]
+        l = self.manifest[key]
         size_list = []
+        full_list = []
+        full_ids = set()
         s = None
         while len(l) > 0:
             n = l.pop()
             try:
                 link_path = os.path.join(self.target, n)
-                s = os.path.getsize(link_path)
-            except (IOError, WindowsError):
+                s, nlink, file_id = links.get_file_info(link_path)
+            except (IOError, OSError):
                 self.notifier.warning('Unable to find in manifest: %s' % n)
                 n = None
                 continue
@@ -148,13 +304,21 @@ class Backup(object):
                 self.notifier.warning('Unable to reuse from manifest due to size (expected %d, was %d): %s' % (s, size, link_path))
                 size_list.append(n)
                 n = None
+            elif nlink >= self.get_link_limit():
+                if file_id not in full_ids:
+                    full_ids.add(file_id)
+                    full_list.append(n)
+                n = None
             else:
                 break
         l.extend(size_list)
+        l.extend(full_list)
         
         l.append(new_path)
         
         if n is None:
+            if len(full_list) > 0:
+                self.notifier.notice('Link limit reached, making a new replica: %s' % item_path)
             return False
             
         l.append(n)
@@ -164,6 +328,38 @@ class Backup(object):
         links.link(link_path, dest_path)
         return True
     
+    def pack_item(self, digests, size, big_buf, item_path):
+        if self.pack_threshold is None or size >= self.pack_threshold or big_buf is None:
+            return False
+        
+        key = self.hash_algorithm, digests[self.hash_algorithm]
+        self.pack_store.add(key, big_buf)
+        self.catalog[os.path.normpath(item_path)] = key
+        return True
+    
+    def reuse_from_catalog(self, item_path):
+        """Carry over the previous backup's catalog entries for this item and
+        anything below it."""
+        item_path = os.path.normpath(item_path)
+        if item_path in self.previous_catalog:
+            self.catalog[item_path] = self.previous_catalog[item_path]
+            return True
+        
+        # The paths under item_path are a contiguous run of the sorted paths.
+        if item_path == '.':
+            start, end = 0, len(self.previous_paths)
+        else:
+            prefix = os.path.join(item_path, '')
+            start = bisect.bisect_left(self.previous_paths, prefix)
+            end = bisect.bisect_left(self.previous_paths, prefix[:-1] + chr(ord(os.sep) + 1), start)
+        for path in self.previous_paths[start:end]:
+            self.catalog[path] = self.previous_catalog[path]
+        return end > start
+    
+    def set_previous_catalog(self, catalog):
+        self.previous_catalog = catalog
+        self.previous_paths = sorted(catalog)
+    
     def reuse_from_previous(self, item_path, source_path):
         previous_path = os.path.join(self.target, self.previous_name, item_path)
         if not os.path.exists(previous_path):
@@ -171,10 +367,13 @@ class Backup(object):
         
         source_path = os.path.join(self.source, item_path)
         item_size = os.path.getsize(source_path)
-        previous_size = os.path.getsize(previous_path)
+        previous_size, previous_nlink, previous_id = links.get_file_info(previous_path)
         if item_size != previous_size:
             return False
         
+        if previous_nlink >= self.get_link_limit():
+            return False
+        
         dest_path = os.path.join(self.target, self.name, item_path)
         try:
             links.link(previous_path, dest_path)
@@ -190,18 +389,46 @@ class Backup(object):
             self.notifier.notice('Reused (from previous): %s' % item_path)
             return
             
-        md5, size, big_buf = self.get_md5(source_path)
-        if self.reuse_from_manifest(md5, size, item_path):
+        extents = sparse.get_extents(source_path)
+        
+        blocks = None
+        if self.delta_min_size is not None and os.path.getsize(source_path) >= self.delta_min_size:
+            blocks = hashes.BlockHashes(DELTA_BLOCK_SIZE)
+        
+        digests, size, big_buf = self.get_hash(source_path, blocks, extents)
+        self.read_bytes += size
+        with self.lock:
+            packed = self.pack_item(digests, size, big_buf, item_path)
+        if packed:
+            self.notifier.notice('Packed: %s' % item_path)
+            return
+        if blocks is not None:
+            new_blocks = size, digests[self.hash_algorithm], blocks.get_digests()
+        with self.lock:
+            reused = self.reuse_from_manifest(digests, size, item_path)
+        if reused:
+            if blocks is not None:
+                self.block_hashes[item_path] = new_blocks
             self.notifier.notice('Reused (from manifest): %s' % item_path)
             return
+        if blocks is not None:
+            written = self.delta_copy_item(item_path, source_path, new_blocks)
+            self.block_hashes[item_path] = new_blocks
+            if written is not None:
+                self.notifier.notice('Delta copied (%d of %d blocks): %s' % (written, len(new_blocks[2]), item_path))
+                return
         dest_path = os.path.join(self.target, self.name, item_path)
         
-        f2 = open(dest_path, 'wb')
-        if big_buf is not None:
+        f2 = self.open_dest(dest_path)
+        if extents is not None:
+            f = self.open_source(source_path)
+            sparse.copy_extents(f, f2, extents, size, BUFFER_SIZE)
+            f.close()
+        elif big_buf is not None:
             for buf in big_buf:
                 f2.write(buf)
         else:
-            f = open(source_path, 'rb')
+            f = self.open_source(source_path)
             while True:
                 buf = f.read(BUFFER_SIZE)
                 if len(buf) == 0:
@@ -211,11 +438,63 @@ class Backup(object):
         f2.close()
         self.notifier.notice('Copied: %s' % item_path)
 
+    def delta_copy_item(self, item_path, source_path, new_blocks):
+        """Clone the previous backup's version of the item, and write just the
+        blocks that differ from it.  Returns the number of blocks written, or
+        None if the item can't be delta copied.  Without reflinks the clone
+        would be a full copy, so a delta is only tried where they work.
+        
+        The block hashes are only trusted if the manifest has the previous
+        copy under the contents digest recorded with them; they are stale if
+        the file was since backed up without them."""
+        if self.previous_name is None or len(self.block_hashes.get(item_path, ())) != 3:
+            return None
+        previous_size, previous_digest, previous_digests = self.block_hashes[item_path]
+        previous_name = os.path.join(self.previous_name, item_path)
+        with self.lock:
+            if previous_name not in self.manifest.get(previous_digest, ()):
+                return None
+        previous_path = os.path.join(self.target, previous_name)
+        try:
+            if os.path.getsize(previous_path) != previous_size:
+                return None
+        except OSError:
+            return None
+        
+        dest_path = os.path.join(self.target, self.name, item_path)
+        try:
+            links.reflink(previous_path, dest_path)
+        except OSError:
+            return None
+        
+        size, digest, digests = new_blocks
+        written = 0
+        f = open(source_path, 'rb')
+        f2 = open(dest_path, 'r+b')
+        for i, digest in enumerate(digests):
+            if i < len(previous_digests) and previous_digests[i] == digest:
+                continue
+            f.seek(i * DELTA_BLOCK_SIZE)
+            f2.seek(i * DELTA_BLOCK_SIZE)
+            f2.write(f.read(DELTA_BLOCK_SIZE))
+            written += 1
+        f2.truncate(size)
+        f2.close()
+        f.close()
+        return written
+    
     def reuse_item(self, item_path):
+        """Link the item to its copy in the previous backup.  Returns False if
+        that copy is a file at the link limit, so that the item is copied
+        (and linked to a replica) instead."""
         source_path = os.path.join(self.source, item_path)
         dest_path = os.path.join(self.target, self.name, item_path)
         link_path = os.path.join(self.target, self.previous_name, item_path)
         if os.path.isfile(source_path):
+            if self.reuse_from_catalog(item_path):
+                return True
+            if links.get_file_info(link_path)[1] >= self.get_link_limit():
+                return False
             try:
                 links.link(link_path, dest_path)
             except Exception, ex:
@@ -223,6 +502,8 @@ class Backup(object):
                 raise ex
         else:
             links.symlink(link_path, dest_path)
+            self.reuse_from_catalog(item_path)
+        return True
 
     def make_dir(self, item_path):
         dest_path = os.path.join(self.target, self.name, item_path)
@@ -238,7 +519,8 @@ class Backup(object):
         return children
     
     def is_excluded(self, item_path):
-        return item_path in self.exclusions
+        source_path = os.path.join(self.source, item_path)
+        return self.exclusions.matches(item_path, source_path)
     
     def is_reusable(self, item_path):
         if not self.enable_journal:
@@ -265,18 +547,22 @@ class Backup(object):
             self.notifier.notice('Excluded: %s' % item_path)
             return
         
+        self.items += 1
+        
         if self.is_reusable(item_path):
             try:
-                self.reuse_item(item_path)
-                self.notifier.notice('Reused: %s' % item_path)
-                return
+                if self.reuse_item(item_path):
+                    self.notifier.notice('Reused: %s' % item_path)
+                    return
             except Exception:
                 self.notifier.notice('Falling back to copy')
                 pass
         
         source_path = os.path.join(self.source, item_path)
         if os.path.isfile(source_path):
+            start_time = time.time()
             self.copy_item(item_path)
+            self.read_time += time.time() - start_time
         elif os.path.isdir(source_path):
             self.make_dir(item_path)
             for c in self.get_children(item_path):
@@ -295,53 +581,95 @@ class Backup(object):
             raise Exception, 'Target with name already exists!'
 
     def read_exclusions(self):
-        self.exclusions = set()
+        errors = []
         try:
-            f = open(os.path.join(self.target, EXCLUSIONS_FILENAME), 'rt')
-            for line in f:
-                line = line.strip()
-                if line == '':
-                    continue
-                
-                self.exclusions.add(line)
-            f.close()
+            self.exclusions = exclusions.read_exclusions(os.path.join(self.target, EXCLUSIONS_FILENAME), errors)
             self.notifier.notice('Read %d exclusions' % len(self.exclusions))
         except IOError:
+            self.exclusions = exclusions.Exclusions()
             self.notifier.warning('Failed to read exclusions file')
+        # A bad line is skipped, rather than losing all the other exclusions.
+        for ex in errors:
+            self.notifier.error('Skipped exclusion that could not be parsed', ex)
 
     def open_journal(self):
-        journal_filename = os.path.join(self.target, JOURNAL_FILENAME)
+        journal_filename = os.path.join(self.target, self.journal_filename)
+        drive = os.path.splitdrive(self.source)[0]
+        self.journal = Journal(drive)
         try:
-            journal_state = unpickle_file(journal_filename)
+            self.journal.load_state(journal_filename)
         except IOError:
             self.notifier.notice('Journal state not found, starting anew')
-            journal_state = (None, None, {})
-        drive = os.path.splitdrive(self.source)[0]
-        self.journal = Journal(drive)
-        self.journal.set_state(journal_state)
         self.notifier.notice('Opened journal')
 
     def close_journal(self):
-        journal_filename = os.path.join(self.target, JOURNAL_FILENAME)
-        journal_state = self.journal.get_state()
-        pickle_to_file(journal_state, journal_filename)
+        journal_filename = os.path.join(self.target, self.journal_filename)
+        self.journal.save_state(journal_filename)
         self.notifier.notice('Closed journal')
     
     def load_manifest(self):
+        """Load the manifest for the current hash algorithm.  Manifests for
+        other algorithms are kept as legacy manifests for one backup, and
+        their entries are migrated as matching contents are found.  The
+        original manifest format was a single dict of MD5s."""
         manifest_filename = os.path.join(self.target, MANIFEST_FILENAME)
         f = open(manifest_filename, 'rb')
-        self.manifest = cPickle.load(f)
+        obj = cPickle.load(f)
         f.close()
+        if isinstance(obj, dict):
+            manifests = {'md5': obj}
+        else:
+            version, manifests = obj
+        self.manifest = manifests.pop(self.hash_algorithm, {})
+        self.legacy_manifests = dict((a, m) for a, m in manifests.iteritems() if len(m) > 0)
+        if len(self.legacy_manifests) > 0:
+            self.notifier.notice('Migrating manifest entries from: %s' % ', '.join(sorted(self.legacy_manifests)))
+    
+    def finish_migration(self):
+        """Drop the legacy manifests after a complete backup.  Entries not
+        migrated by then are for contents that weren't found, and keeping
+        them would mean hashing every file with the legacy algorithms too,
+        for ever."""
+        count = sum(len(m) for m in self.legacy_manifests.itervalues())
+        if count > 0:
+            self.notifier.notice('Dropping %d unmigrated legacy manifest entries' % count)
+        self.legacy_manifests.clear()
     
     def save_manifest(self):
+        manifests = dict((a, m) for a, m in self.legacy_manifests.iteritems() if len(m) > 0)
+        manifests[self.hash_algorithm] = self.manifest
         manifest_filename = os.path.join(self.target, MANIFEST_FILENAME)
         f = open(manifest_filename, 'wb')
-        cPickle.dump(self.manifest, f)
+        cPickle.dump((MANIFEST_VERSION, manifests), f)
         f.close()        
 
-    def run(self):
-        self.check_target()
+    def open_packs(self):
+        self.catalog = {}
+        self.set_previous_catalog({})
+        if self.pack_threshold is None and not os.path.exists(os.path.join(self.target, packs.PACKS_DIRNAME)):
+            self.pack_store = None
+            return
         
+        self.pack_store = packs.PackStore(self.target)
+        self.pack_store.open()
+        if self.previous_name is not None:
+            try:
+                self.set_previous_catalog(self.pack_store.load_catalog(self.previous_name))
+            except IOError:
+                self.notifier.notice('No catalog for previous backup')
+        self.notifier.notice('Opened packs')
+
+    def close_packs(self):
+        if self.pack_store is None:
+            return
+        
+        self.pack_store.save_catalog(self.name, self.catalog)
+        self.pack_store.close()
+        self.notifier.notice('Closed packs (%d items in catalog)' % len(self.catalog))
+
+    def load_state(self):
+        """Load the state kept in the target: the previous backup name,
+        exclusions, journal and manifest."""
         try:
             prev_filename = os.path.join(self.target, PREVIOUS_FILENAME)
             self.previous_name = unpickle_file(prev_filename)
@@ -350,42 +678,385 @@ class Backup(object):
         
         self.read_exclusions()
         self.exclusions.add(self.target)
+        self.exclusions.compile()
         
         if self.enable_journal:
             self.open_journal()
-            self.journal.process()
         
+        self.load_reuse_state()
+    
+    def load_reuse_state(self):
+        """Load the manifest, and block hashes if they are used."""
         try:
             self.load_manifest()
         except IOError:
             self.manifest = {}
+            self.legacy_manifests = {}
         
+        if self.delta_min_size is not None:
+            try:
+                self.block_hashes = unpickle_file(os.path.join(self.target, BLOCKS_FILENAME))
+            except IOError:
+                self.block_hashes = {}
+
+    def take_snapshot(self):
+        """Back up the source into a new backup with the current name."""
+        self.open_packs()
+        
+        self.clear_stats()
+        start_time = time.time()
         self.backup_item('')
+        self.elapsed = time.time() - start_time
+        
+        self.close_packs()
+
+    def save_stats(self):
+        stats = self.items, self.read_bytes, self.read_time, self.elapsed
+        pickle_to_file(stats, os.path.join(self.target, STATS_FILENAME))
+
+    def save_block_hashes(self):
+        if self.delta_min_size is not None:
+            pickle_to_file(self.block_hashes, os.path.join(self.target, BLOCKS_FILENAME))
+
+    def save_previous(self):
+        prev_filename = os.path.join(self.target, PREVIOUS_FILENAME)
+        pickle_to_file(self.name, prev_filename)
+        self.previous_name = self.name
+
+    def run(self):
+        self.check_target()
+        
+        self.load_state()
+        
+        if self.enable_journal:
+            self.journal.process()
+        
+        self.take_snapshot()
+        
+        self.finish_migration()
         
         self.save_manifest()
         
+        self.save_block_hashes()
+        
+        self.save_stats()
+        
         if self.enable_journal:
             self.close_journal()
         
-        prev_filename = os.path.join(self.target, PREVIOUS_FILENAME)
-        pickle_to_file(self.name, prev_filename)
+        self.save_previous()
 
 
-def parse_command_line(argv=None):
-    parser = OptionParser(usage="%prog [options] SOURCE TARGET\n       %prog -h (for help)", add_help_option=True)
-    parser.add_option("-n", "--name", default=None, action='store',
-                      help="name of backup (defaults to date)")
+class MultiBackup(Backup):
+    """A backup of several sources, each into its own subtree.  Each source
+    has a Backup of its own, with its own journal and stats, but sharing
+    the exclusions, manifest and packs.  A source that fails is reported
+    without stopping the others."""
+
+    def __init__(self):
+        Backup.__init__(self)
+        self.sources = []
+        self.source_backups = []
+        self.failures = {}
+
+    def open_journal(self):
+        # Each source's journal is opened when it is backed up.
+        pass
+
+    def make_source_backup(self, source):
+        name = get_source_name(source)
+        b = Backup()
+        b.notifier = PrefixNotifier(self.notifier, name)
+        b.source = source
+        b.target = self.target
+        b.name = os.path.join(self.name, name)
+        if self.previous_name is not None:
+            b.previous_name = os.path.join(self.previous_name, name)
+        else:
+            b.previous_name = None
+        b.enable_journal = self.enable_journal
+        b.journal_filename = '%s-%s' % (JOURNAL_FILENAME, name)
+        b.enable_dir_reuse = self.enable_dir_reuse
+        b.enable_fast_reuse = self.enable_fast_reuse
+        b.pack_threshold = self.pack_threshold
+        b.cache_neutral = self.cache_neutral
+        b.hash_algorithm = self.hash_algorithm
+        b.delta_min_size = self.delta_min_size
+        b.lock = self.lock
+        b.exclusions = self.exclusions
+        b.manifest = self.manifest
+        b.legacy_manifests = self.legacy_manifests
+        b.pack_store = self.pack_store
+        b.catalog = {}
+        b.set_previous_catalog(split_paths(self.previous_catalog, name))
+        b.block_hashes = split_paths(self.block_hashes, name)
+        return b
+
+    def backup_source(self, b):
+        start_time = time.time()
+        try:
+            if not os.path.isdir(b.source):
+                raise Exception, 'Source not found'
+            if b.enable_journal:
+                b.open_journal()
+                b.journal.process()
+            b.backup_item('')
+            if b.enable_journal:
+                b.close_journal()
+        except Exception, ex:
+            b.notifier.error('Backup of %s failed' % b.source, ex)
+            self.failures[b.source] = ex
+            # The subtree is incomplete, so the next backup mustn't reuse
+            # it on the journal's say-so.
+            journal_filename = os.path.join(self.target, b.journal_filename)
+            if os.path.exists(journal_filename):
+                os.remove(journal_filename)
+        b.elapsed = time.time() - start_time
+
+    def backup_sources(self, backups):
+        for b in backups:
+            self.backup_source(b)
+
+    def take_snapshot(self):
+        """Back up each source into its subtree of the new backup.  The
+        sources on each device are backed up in turn, in a thread for that
+        device."""
+        self.open_packs()
+        self.make_dir('')
+        
+        self.failures = {}
+        self.source_backups = [self.make_source_backup(source) for source in self.sources]
+        devices = {}
+        for b in self.source_backups:
+            devices.setdefault(get_device(b.source), []).append(b)
+        threads = [threading.Thread(target=self.backup_sources, args=(backups,)) for backups in devices.values()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        self.clear_stats()
+        self.block_hashes = {}
+        for b in self.source_backups:
+            name = get_source_name(b.source)
+            self.catalog.update(join_paths(b.catalog, name))
+            self.block_hashes.update(join_paths(b.block_hashes, name))
+            self.items += b.items
+            self.read_bytes += b.read_bytes
+            self.read_time += b.read_time
+            self.elapsed += b.elapsed
+            if b.source in self.failures:
+                self.notifier.error('Failed source %s after %d items' % (b.source, b.items), self.failures[b.source])
+            else:
+                self.notifier.notice('Backed up source %s: %d items, %d bytes read, %.1f seconds' % (b.source, b.items, b.read_bytes, b.elapsed))
+        
+        self.close_packs()
+
+    def run(self):
+        self.check_target()
+        
+        self.load_state()
+        
+        self.take_snapshot()
+        
+        if len(self.failures) == len(self.sources):
+            raise Exception, 'All sources failed!'
+        
+        if len(self.failures) == 0:
+            self.finish_migration()
+        
+        self.save_manifest()
+        
+        self.save_block_hashes()
+        
+        self.save_stats()
+        
+        self.save_previous()
+
+
+class Estimate(Backup):
+    """A dry run of a backup, making the same decisions as far as possible
+    from metadata alone.  No file contents are read and nothing is written.
+    Fast reuse is decided exactly as in a backup.  Otherwise a file is
+    assumed unchanged (and will be linked from the manifest) if the previous
+    backup has it with the same size, and it was last modified before that
+    copy was made."""
+
+    def __init__(self):
+        Backup.__init__(self)
+        self.counts = {}
+        self.sizes = {}
+
+    def add(self, kind, size=0):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.sizes[kind] = self.sizes.get(kind, 0) + size
+
+    def check_target(self):
+        if os.path.exists(os.path.join(self.target, self.name)):
+            raise Exception, 'Target with name already exists!'
+
+    def is_excluded(self, item_path):
+        if Backup.is_excluded(self, item_path):
+            self.add('excluded')
+            return True
+        return False
+
+    def load_reuse_state(self):
+        # The estimate doesn't use the manifest or block hashes, and they can
+        # take a while to load.
+        pass
+
+    def is_fast_reusable(self, item_path, st):
+        """Would reuse_from_previous link the item?"""
+        if self.previous_name is None:
+            return False
+        previous_path = os.path.join(self.target, self.previous_name, item_path)
+        try:
+            previous_size, previous_nlink, previous_id = links.get_file_info(previous_path)
+        except OSError:
+            return False
+        return previous_size == st.st_size and previous_nlink < self.get_link_limit()
+
+    def is_unchanged(self, item_path, st):
+        if self.previous_name is None:
+            return False
+        previous_path = os.path.join(self.target, self.previous_name, item_path)
+        try:
+            previous_st = os.stat(previous_path)
+        except OSError:
+            return False
+        return previous_st.st_size == st.st_size and st.st_mtime <= previous_st.st_mtime
+
+    def copy_item(self, item_path):
+        # The same order of decisions as Backup.copy_item.
+        st = os.stat(os.path.join(self.source, item_path))
+        if self.enable_fast_reuse and self.is_fast_reusable(item_path, st):
+            self.add('fast reused', st.st_size)
+        elif self.pack_threshold is not None and st.st_size < self.pack_threshold:
+            self.add('packed', st.st_size)
+        elif self.is_unchanged(item_path, st):
+            self.add('linked', st.st_size)
+        else:
+            self.add('copied', st.st_size)
+
+    def reuse_item(self, item_path):
+        source_path = os.path.join(self.source, item_path)
+        if os.path.isfile(source_path):
+            previous_path = os.path.join(self.target, self.previous_name, item_path)
+            if links.get_file_info(previous_path)[1] >= self.get_link_limit():
+                return False
+            self.add('reused', os.path.getsize(source_path))
+        else:
+            self.add('reused dirs')
+        return True
+
+    def make_dir(self, item_path):
+        self.add('dirs')
+
+    def get_eta(self):
+        """Estimate the duration from the throughput measured in the last
+        backup: the time spent reading and hashing files, per byte, and the
+        rest, per item.  Returns None if no backup has been measured."""
+        try:
+            items, read_bytes, read_time, elapsed = unpickle_file(os.path.join(self.target, STATS_FILENAME))
+        except IOError:
+            return None
+        if items == 0:
+            return None
+        eta = self.items * (elapsed - read_time) / items
+        to_read = self.sizes.get('copied', 0) + self.sizes.get('packed', 0) + self.sizes.get('linked', 0)
+        if read_bytes > 0:
+            eta += to_read * read_time / read_bytes
+        return eta
+
+    def report(self):
+        for kind in sorted(self.counts):
+            if self.sizes[kind] > 0:
+                self.notifier.notice('Estimated %s: %d items, %d bytes' % (kind, self.counts[kind], self.sizes[kind]))
+            else:
+                self.notifier.notice('Estimated %s: %d items' % (kind, self.counts[kind]))
+        eta = self.get_eta()
+        if eta is None:
+            self.notifier.notice('No throughput measured yet, so no estimated duration')
+        else:
+            self.notifier.notice('Estimated duration: %d seconds' % eta)
+
+    def run(self):
+        self.check_target()
+        
+        self.load_state()
+        
+        if self.enable_journal:
+            self.journal.process()
+        
+        self.clear_stats()
+        self.backup_item('')
+        
+        self.report()
+
+
+def add_options(parser):
+    """Add the options that configure a Backup (shared with backupd.py)."""
     parser.add_option("-j", "--use-journal", default=False, action='store_true',
                       help="use USN journal")
     parser.add_option("-r", "--fast-reuse", default=False, action='store_true',
                       help="reuse previous files without checking contents")
+    parser.add_option("-p", "--pack-threshold", default=None, action='store', type='int',
+                      help="store files smaller than this many bytes in pack files")
+    parser.add_option("-c", "--cache-neutral", default=False, action='store_true',
+                      help="avoid filling the page cache with backup data")
+    parser.add_option("-a", "--hash", default=hashes.DEFAULT_ALGORITHM, action='store',
+                      help="content hash algorithm, e.g. md5, blake2b, tree-blake2b")
+    parser.add_option("-d", "--delta-min-size", default=None, action='store', type='int',
+                      help="update changed files of this many bytes or more by block, via reflinks")
+
+
+def check_options(parser, options):
+    if options.use_journal and not ALLOW_JOURNAL:
+        parser.error('Journal cannot be used on this system')
+    
+    if not hashes.is_available(options.hash):
+        parser.error('Hash algorithm %s is not available' % options.hash)
+    
+    if options.cache_neutral and not cacheio.is_available():
+        parser.error('Cache-neutral I/O cannot be used on this system')
+
+
+def apply_options(backup, options):
+    backup.enable_dir_reuse = True
+    if options.use_journal:
+        backup.enable_journal = True
+    if options.fast_reuse:
+        backup.enable_fast_reuse = True
+    if options.pack_threshold is not None:
+        backup.pack_threshold = options.pack_threshold
+    if options.cache_neutral:
+        backup.cache_neutral = True
+    backup.hash_algorithm = options.hash
+    if options.delta_min_size is not None:
+        backup.delta_min_size = options.delta_min_size
+
+
+def parse_command_line(argv=None):
+    parser = OptionParser(usage="%prog [options] SOURCE [SOURCE...] TARGET\n       %prog -h (for help)", add_help_option=True)
+    parser.add_option("-n", "--name", default=None, action='store',
+                      help="name of backup (defaults to date)")
+    add_options(parser)
+    parser.add_option("-e", "--estimate", "--dry-run", default=False, action='store_true',
+                      help="estimate the size and duration of the backup, without doing it")
     options, args = parser.parse_args(argv[1:])
 
-    if len(args) != 2:
+    if len(args) < 2:
         parser.error('Source and target arguments required')
     
-    if options.use_journal and not ALLOW_JOURNAL:
-        parser.error('Journal cannot be used on this system')
+    if len(args) > 2:
+        if options.estimate:
+            parser.error('Only a single source can be estimated')
+        names = [get_source_name(source) for source in args[:-1]]
+        if '' in names or len(set(names)) != len(names):
+            parser.error('Sources must have distinct names (drive letters or last path components)')
+    
+    check_options(parser, options)
     
     return options, args
 
@@ -396,20 +1067,26 @@ def main(args=None):
     
     options, args = parse_command_line(args)
     
-    backup = Backup()
+    if len(args) > 2:
+        backup = MultiBackup()
+        backup.sources = args[:-1]
+    elif options.estimate:
+        backup = Estimate()
+        backup.source = args[0]
+    else:
+        backup = Backup()
+        backup.source = args[0]
     backup.notifier = ConsoleNotifier(backup)
-    backup.source = args[0]
-    backup.target = args[1]
+    backup.target = args[-1]
     if options.name is not None:
         backup.name = options.name
     else:
         backup.name = time.strftime('%Y%m%d')
-    backup.enable_dir_reuse = True
-    if options.use_journal:
-        backup.enable_journal = True
-    if options.fast_reuse:
-        backup.enable_fast_reuse = True
+    apply_options(backup, options)
     backup.run()
+    
+    if len(args) > 2 and len(backup.failures) > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
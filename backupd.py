@@ -0,0 +1,245 @@
+"""A long-running backup daemon.
+
+Running backup.py for each snapshot means loading the journal state and
+manifest, and saving them again, every time.  The daemon loads them once
+and keeps them in memory, along with the changes read from the journal
+since the last snapshot.  The journal is polled every POLL_INTERVAL
+seconds, and a snapshot is taken every INTERVAL seconds, or when asked
+for over a local socket.  Each snapshot only walks the directories the
+journal says are affected; the rest are reused from the previous one.
+
+After each snapshot the journal state is saved (which only appends the
+dir map's changes), along with the previous backup name.  It is not saved
+otherwise, so that changes polled since the last snapshot are read again
+by the next run.  The manifest
+only guides reuse, so it is saved every MANIFEST_SAVE_INTERVAL snapshots
+and when the daemon stops.
+
+Commands, one per connection, as a line of text:
+  - snapshot [NAME]: take a snapshot now, replying with its name.
+  - status: reply with the last snapshot and the changes pending.
+  - stop: save everything and exit.
+
+Example:
+
+backupd.py -j -i 3600 C:/ C:/snapshots
+backupd.py --send snapshot
+"""
+
+import sys
+import os
+import time
+import socket
+import select
+from optparse import OptionParser
+
+import backup
+
+
+INTERVAL = 3600
+POLL_INTERVAL = 60
+MANIFEST_SAVE_INTERVAL = 24
+
+DEFAULT_PORT = 8137
+COMMAND_TIMEOUT = 10
+NAME_FORMAT = '%Y%m%d-%H%M%S'
+
+
+def is_valid_name(name):
+    """Is the name safe to use as a backup directory in the target?  Names
+    come from anyone who can connect to the command port."""
+    if name in ('', '.', '..') or os.path.isabs(name) or os.path.splitdrive(name)[0] != '':
+        return False
+    return os.sep not in name and (os.altsep is None or os.altsep not in name)
+
+
+class BackupDaemon(object):
+    """Keeps a Backup's state resident, and takes snapshots with it."""
+
+    def __init__(self, backup):
+        self.backup = backup
+        self.notifier = backup.notifier
+        self.interval = INTERVAL
+        self.poll_interval = POLL_INTERVAL
+        self.manifest_save_interval = MANIFEST_SAVE_INTERVAL
+        self.port = DEFAULT_PORT
+        self.snapshots_since_manifest_save = 0
+        self.stopping = False
+
+    def poll(self):
+        if self.backup.enable_journal:
+            self.backup.journal.process(clear=False)
+
+    def snapshot(self, name=None):
+        if name is None:
+            name = time.strftime(NAME_FORMAT)
+        if not is_valid_name(name):
+            raise ValueError('Invalid backup name: %s' % name)
+        b = self.backup
+        b.name = name
+        b.check_target()
+        self.poll()
+        b.take_snapshot()
+        b.finish_migration()
+
+        if b.enable_journal:
+            b.journal.clear_changes()
+            b.close_journal()
+        b.save_stats()
+        b.save_block_hashes()
+        b.save_previous()
+
+        self.snapshots_since_manifest_save += 1
+        if self.snapshots_since_manifest_save >= self.manifest_save_interval:
+            self.save_manifest()
+        self.notifier.notice('Snapshot taken: %s' % name)
+        return name
+
+    def save_manifest(self):
+        self.backup.save_manifest()
+        self.snapshots_since_manifest_save = 0
+
+    def status(self):
+        b = self.backup
+        msg = 'last snapshot %s' % b.previous_name
+        if b.enable_journal:
+            j = b.journal
+            if j.everything_changed:
+                msg += ', everything changed'
+            else:
+                msg += ', %d changes, %d changed dirs' % (len(j.changed), len(j.changed_dirs))
+        return msg
+
+    def handle_command(self, line):
+        words = line.split()
+        if len(words) == 0:
+            return 'error empty command'
+        command = words[0]
+        if command == 'snapshot':
+            name = None
+            if len(words) > 1:
+                name = words[1]
+            try:
+                return 'ok %s' % self.snapshot(name)
+            except Exception, ex:
+                self.notifier.error('Snapshot failed', ex)
+                return 'error %s' % ex
+        elif command == 'status':
+            return 'ok %s' % self.status()
+        elif command == 'stop':
+            self.stopping = True
+            return 'ok stopping'
+        return 'error unknown command %s' % command
+
+    def handle_connection(self, sock):
+        conn, addr = sock.accept()
+        # A client that never sends its command mustn't hold up polls and
+        # snapshots.
+        conn.settimeout(COMMAND_TIMEOUT)
+        try:
+            f = conn.makefile('rb')
+            try:
+                line = f.readline()
+            finally:
+                f.close()
+            reply = self.handle_command(line.strip())
+            conn.sendall(reply + '\n')
+        except socket.error, ex:
+            self.notifier.warning('Command connection failed: %s' % ex)
+        finally:
+            conn.close()
+
+    def run(self):
+        self.backup.load_state()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', self.port))
+        sock.listen(5)
+        self.notifier.notice('Listening on port %d' % self.port)
+
+        now = time.time()
+        next_snapshot = now + self.interval
+        next_poll = now
+        try:
+            while not self.stopping:
+                timeout = max(0, min(next_snapshot, next_poll) - time.time())
+                readable, writable, errors = select.select([sock], [], [], timeout)
+                if len(readable) > 0:
+                    self.handle_connection(sock)
+
+                now = time.time()
+                if now >= next_poll:
+                    try:
+                        self.poll()
+                    except Exception, ex:
+                        self.notifier.error('Poll failed', ex)
+                    next_poll = now + self.poll_interval
+                if now >= next_snapshot:
+                    try:
+                        self.snapshot()
+                    except Exception, ex:
+                        self.notifier.error('Scheduled snapshot failed', ex)
+                    next_snapshot = max(next_snapshot + self.interval, time.time())
+        finally:
+            sock.close()
+            # The journal state is only saved with a snapshot; saving it now
+            # would skip the changes polled since, which no snapshot has.
+            self.save_manifest()
+
+
+def send_command(command, port=DEFAULT_PORT):
+    sock = socket.create_connection(('127.0.0.1', port))
+    try:
+        sock.sendall(command + '\n')
+        f = sock.makefile('rb')
+        reply = f.readline()
+        f.close()
+    finally:
+        sock.close()
+    return reply.strip()
+
+
+def parse_command_line(argv=None):
+    parser = OptionParser(usage="%prog [options] SOURCE TARGET\n       %prog --send COMMAND\n       %prog -h (for help)", add_help_option=True)
+    backup.add_options(parser)
+    parser.add_option("-i", "--interval", default=INTERVAL, action='store', type='int',
+                      help="seconds between snapshots")
+    parser.add_option("--port", default=DEFAULT_PORT, action='store', type='int',
+                      help="local port to listen on for commands")
+    parser.add_option("--send", default=None, action='store',
+                      help="send a command to a running daemon")
+    options, args = parser.parse_args(argv[1:])
+
+    if options.send is None and len(args) != 2:
+        parser.error('Source and target arguments required')
+
+    backup.check_options(parser, options)
+
+    return options, args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    options, args = parse_command_line(argv)
+
+    if options.send is not None:
+        print send_command(options.send, options.port)
+        return
+
+    b = backup.Backup()
+    b.notifier = backup.ConsoleNotifier(b)
+    b.source = args[0]
+    b.target = args[1]
+    backup.apply_options(b, options)
+
+    daemon = BackupDaemon(b)
+    daemon.interval = options.interval
+    daemon.port = options.port
+    daemon.run()
+
+
+if __name__ == '__main__':
+    main()
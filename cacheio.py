@@ -0,0 +1,132 @@
+"""File I/O that leaves the page cache alone.
+
+Reading a whole drive for a backup would normally push everything else out
+of the page cache, and fill it with data that will not be read again.  The
+files here tell the OS to read ahead sequentially, and to drop the pages
+once they have been used (POSIX_FADV_DONTNEED).  Large files can also be
+read with O_DIRECT, into page-aligned buffers, bypassing the cache entirely.
+
+Where posix_fadvise is not available (e.g. Windows), the files behave like
+ordinary files.
+"""
+
+import os
+import io
+import mmap
+
+
+ALIGNMENT = mmap.PAGESIZE
+WRITEBACK_SIZE = 32*1024*1024
+DIRECT_MIN_SIZE = 64*1024*1024
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+try:
+    posix_fadvise = os.posix_fadvise
+except AttributeError:
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+
+        def posix_fadvise(fd, offset, length, advice):
+            _libc.posix_fadvise(fd, offset, length, advice)
+    except (ImportError, OSError, AttributeError, TypeError):
+        posix_fadvise = None
+
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def is_available():
+    return posix_fadvise is not None
+
+
+class CacheNeutralReader(object):
+    """A file opened for sequential reading, whose pages are dropped from
+    the cache after being read."""
+
+    def __init__(self, path, direct=False):
+        flags = os.O_RDONLY | O_BINARY
+        if direct and O_DIRECT:
+            flags |= O_DIRECT
+            self.buf = None
+        else:
+            direct = False
+        self.direct = direct
+        self.fd = os.open(path, flags)
+        self.file = io.FileIO(self.fd, 'r', closefd=False)
+        self.pos = 0
+        if posix_fadvise is not None:
+            posix_fadvise(self.fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+    def read(self, size):
+        if self.direct:
+            size = (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+            if self.buf is None or len(self.buf) != size:
+                # Anonymous maps are page-aligned, as O_DIRECT requires.
+                self.buf = mmap.mmap(-1, size)
+            n = self.file.readinto(self.buf)
+            data = self.buf[:n]
+        else:
+            data = self.file.read(size)
+        if posix_fadvise is not None and len(data) > 0:
+            posix_fadvise(self.fd, self.pos, len(data), POSIX_FADV_DONTNEED)
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos):
+        self.file.seek(pos)
+        self.pos = pos
+
+    def close(self):
+        self.file.close()
+        os.close(self.fd)
+        if self.direct and self.buf is not None:
+            self.buf.close()
+            self.buf = None
+
+
+class CacheNeutralWriter(object):
+    """A file opened for writing, whose pages are flushed and dropped from
+    the cache every WRITEBACK_SIZE bytes."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY, 0666)
+        self.file = io.FileIO(self.fd, 'w', closefd=False)
+        self.pos = 0
+        self.synced_pos = 0
+
+    def write(self, buf):
+        written = 0
+        while written < len(buf):
+            written += self.file.write(buf[written:])
+        self.pos += len(buf)
+        if self.pos - self.synced_pos >= WRITEBACK_SIZE:
+            self.drop()
+
+    def seek(self, pos):
+        self.drop()
+        self.file.seek(pos)
+        self.pos = pos
+        self.synced_pos = pos
+
+    def truncate(self, size):
+        self.file.truncate(size)
+
+    def drop(self):
+        if posix_fadvise is None:
+            return
+        # Dirty pages cannot be dropped, so write them out first.
+        fdatasync(self.fd)
+        posix_fadvise(self.fd, self.synced_pos, self.pos - self.synced_pos, POSIX_FADV_DONTNEED)
+        self.synced_pos = self.pos
+
+    def close(self):
+        self.drop()
+        self.file.close()
+        os.close(self.fd)
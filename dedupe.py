@@ -1,42 +1,32 @@
 import sys
 import os
-import hashlib
 
 import journalcmd
+import hashes
 
 
-BUFFER_SIZE = 65536
-
 class Deduper(object):
     def __init__(self):
         self.frn_map = {}
-        self.md5_map = {}
+        self.hash_map = {}
         self.manifest = {}
+        self.algorithm = hashes.DEFAULT_ALGORITHM
 
     def get_file_frn(self, path):
         tups, name = journalcmd.read_file_usn(path)
         return tups[3]
     
-    def get_file_md5(self, path):
+    def get_file_hash(self, path):
         path = os.path.normpath(path)
         
         if path in self.manifest:
             return self.manifest[path]
         
-        f = open(path, 'rb')
-        m = hashlib.md5()
-        while True:
-            buf = f.read(BUFFER_SIZE)
-            if len(buf) == 0:
-                break
-            m.update(buf)
-        f.close()
-        
-        md5 = m.hexdigest()
+        digest = hashes.hash_file(self.algorithm, path)
         
-        self.manifest[path] = md5
-        print '%s *%s' % (md5, path)
-        return md5
+        self.manifest[path] = digest
+        print '%s:%s *%s' % (self.algorithm, digest, path)
+        return digest
 
     def dedupe_file(self, path):
         frn = self.get_file_frn(path)
@@ -44,15 +34,15 @@ class Deduper(object):
             self.frn_map[frn].append(path)
             return
         
-        md5 = self.get_file_md5(path)
-        if md5 not in self.md5_map:
-            self.md5_map[md5] = path
+        digest = self.get_file_hash(path)
+        if digest not in self.hash_map:
+            self.hash_map[digest] = path
             self.frn_map[frn] = [path]
             return
         
-        from_path = self.md5_map[md5]
+        from_path = self.hash_map[digest]
         print 'Can dedupe: %s (from %s)' % (path, from_path)
-        self.md5_map[md5] = path
+        self.hash_map[digest] = path
         self.frn_map[frn] = [path]
 
     def dedupe_dir(self, dirpath):
@@ -66,9 +56,16 @@ class Deduper(object):
     def load_manifest(self, filename):
         f = open(filename, 'rt')
         for line in f:
-            md5, path = line.strip().split(' *', 1)
+            digest, path = line.strip().split(' *', 1)
+            # Lines are ALGORITHM:DIGEST, or just an MD5 in the original format.
+            if ':' in digest:
+                algorithm, digest = digest.split(':', 1)
+            else:
+                algorithm = 'md5'
+            if algorithm != self.algorithm:
+                continue
             path = os.path.normpath(path)
-            self.manifest[path] = md5
+            self.manifest[path] = digest
         f.close()
         
     def run(self, target):
@@ -77,6 +74,8 @@ class Deduper(object):
 def main():
     target = sys.argv[1]
     d = Deduper()
+    if len(sys.argv) > 3:
+        d.algorithm = sys.argv[3]
     d.load_manifest(sys.argv[2])
     d.run(target)
 
@@ -0,0 +1,230 @@
+"""Exclusion rules for backups.
+
+Each line of the exclusions file is one of:
+
+  - A plain path, relative to the source, which is excluded exactly
+    (e.g. windows/temp).
+  - A gitignore-style pattern, recognised by containing any of * ? [ or
+    ending in /.  A pattern with no / (other than a trailing one) matches a
+    name at any depth; otherwise it is matched against the whole path.  A
+    trailing / makes it match directories only.  ** matches any number of
+    directories (e.g. **/node_modules/, cache/**, *.tmp, __pycache__/).
+  - A size or age rule, which excludes files larger or older than a limit,
+    optionally only those matching a pattern (e.g. "size > 4G",
+    "age > 365d *.log").  Sizes can end in K, M, G or T; ages in s, m, h, d
+    or w (days by default).
+
+Lines starting with # are ignored.  All the patterns are compiled into a
+few combined regular expressions, so matching an item costs the same
+however many rules there are.
+"""
+
+import os
+import os.path
+import re
+import stat
+import time
+
+
+GLOB_CHARS = '*?['
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7*86400}
+
+# The unit must follow the number directly, and the pattern be separated from
+# it by whitespace, so that a pattern's first letter isn't taken as the unit.
+RULE_RE = re.compile(r'^(size|age)\s*>\s*(\d+)([A-Za-z]?)(?:\s+(.*))?$')
+
+CASE_INSENSITIVE = os.path.normcase('A') == 'a'
+
+
+def normalise(item_path):
+    return item_path.replace('\\', '/').strip('/')
+
+
+def translate(pattern):
+    """Translate a glob pattern (without any trailing /) into a regular
+    expression matching a whole path or name."""
+    i = 0
+    n = len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            res.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == n:
+            res.append('/.*')
+            i += 3
+        elif pattern.startswith('**', i):
+            res.append('.*')
+            i += 2
+        elif c == '*':
+            res.append('[^/]*')
+            i += 1
+        elif c == '?':
+            res.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j < 0:
+                res.append(re.escape(c))
+                i += 1
+                continue
+            stuff = pattern[i+1:j].replace('\\', '\\\\')
+            if stuff[0] == '!':
+                stuff = '^' + stuff[1:]
+            res.append('[%s]' % stuff)
+            i = j + 1
+        else:
+            res.append(re.escape(c))
+            i += 1
+    return ''.join(res)
+
+
+def compile_patterns(regexes):
+    if len(regexes) == 0:
+        return None
+    flags = re.IGNORECASE if CASE_INSENSITIVE else 0
+    return re.compile('^(?:%s)$' % '|'.join(regexes), flags)
+
+
+class Rule(object):
+    """Exclude files whose size (or age) exceeds a limit."""
+
+    def __init__(self, kind, limit, pattern):
+        self.kind = kind
+        self.limit = limit
+        self.pattern = pattern
+        if pattern == '':
+            self.regex = None
+        elif '/' in pattern:
+            self.regex = compile_patterns([translate(pattern.lstrip('/'))])
+        else:
+            self.regex = compile_patterns(['(?:.*/)?' + translate(pattern)])
+
+    def matches(self, path, st, now):
+        if self.regex is not None and not self.regex.match(path):
+            return False
+        if self.kind == 'size':
+            return st.st_size > self.limit
+        else:
+            return now - st.st_mtime > self.limit
+
+
+class Exclusions(object):
+    """A set of exclusions, compiled into a single matcher."""
+
+    def __init__(self):
+        self.exact = set()
+        self.name_patterns = []
+        self.path_patterns = []
+        self.dir_name_patterns = []
+        self.dir_path_patterns = []
+        self.rules = []
+        self.compile()
+
+    def __len__(self):
+        return (len(self.exact) + len(self.name_patterns) + len(self.path_patterns)
+                + len(self.dir_name_patterns) + len(self.dir_path_patterns) + len(self.rules))
+
+    def add(self, line):
+        """Add a line from the exclusions file.  compile must be called
+        before the new exclusion takes effect."""
+        m = RULE_RE.match(line)
+        if m is not None:
+            kind, amount, unit, pattern = m.groups()
+            if pattern is None:
+                pattern = ''
+            units = SIZE_UNITS if kind == 'size' else AGE_UNITS
+            if kind == 'size':
+                unit = unit.upper()
+            if unit == '' and kind == 'age':
+                unit = 'd'
+            if unit not in units:
+                raise ValueError('Unknown unit in exclusion: %s' % line)
+            self.rules.append(Rule(kind, int(amount) * units[unit], pattern.strip()))
+            return
+
+        dir_only = line.endswith('/')
+        pattern = line.rstrip('/')
+        if not dir_only and not any(c in pattern for c in GLOB_CHARS):
+            # A leading / only anchors the path to the source, as it already is.
+            self.exact.add(pattern.lstrip('/'))
+            return
+
+        if '/' in pattern:
+            regex = translate(pattern.lstrip('/'))
+            if dir_only:
+                self.dir_path_patterns.append(regex)
+            else:
+                self.path_patterns.append(regex)
+        else:
+            regex = translate(pattern)
+            if dir_only:
+                self.dir_name_patterns.append(regex)
+            else:
+                self.name_patterns.append(regex)
+
+    def compile(self):
+        self.name_re = compile_patterns(self.name_patterns)
+        self.path_re = compile_patterns(self.path_patterns)
+        self.dir_name_re = compile_patterns(self.dir_name_patterns)
+        self.dir_path_re = compile_patterns(self.dir_path_patterns)
+        self.now = time.time()
+
+    def matches(self, item_path, source_path):
+        """Is the item excluded?  The source is only examined (with a single
+        stat) if a directory pattern or a size or age rule needs it."""
+        if item_path in self.exact:
+            return True
+
+        path = normalise(item_path)
+        name = path[path.rfind('/')+1:]
+        if self.name_re is not None and self.name_re.match(name):
+            return True
+        if self.path_re is not None and self.path_re.match(path):
+            return True
+
+        dir_match = ((self.dir_name_re is not None and self.dir_name_re.match(name))
+                or (self.dir_path_re is not None and self.dir_path_re.match(path)))
+        if not dir_match and len(self.rules) == 0:
+            return False
+
+        try:
+            st = os.stat(source_path)
+        except OSError:
+            return False
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if dir_match and is_dir:
+            return True
+        if is_dir:
+            return False
+
+        for rule in self.rules:
+            if rule.matches(path, st, self.now):
+                return True
+        return False
+
+
+def read_exclusions(filename, errors=None):
+    """Read an exclusions file.  If a list is given for errors, lines that
+    can't be parsed are skipped and their ValueErrors added to it; otherwise
+    the first one is raised."""
+    exclusions = Exclusions()
+    f = open(filename, 'rt')
+    for line in f:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+
+        try:
+            exclusions.add(line)
+        except ValueError, ex:
+            if errors is None:
+                f.close()
+                raise
+            errors.append(ex)
+    f.close()
+    exclusions.compile()
+    return exclusions
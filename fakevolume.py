@@ -0,0 +1,237 @@
+"""Stand-ins for a live NTFS volume, for testing and benchmarking the journal
+code on any platform.
+
+  - CapturingVolume wraps a live volume, and records every FSCTL request and
+    its raw result buffer (or error) to a capture file.
+  - ReplayVolume answers requests from a capture file.
+  - SyntheticVolume simulates a volume: a tree of files and directories, a
+    USN journal recording changes to them, and the MFT.  The journal can be
+    truncated (so that old records give ERROR_JOURNAL_ENTRY_DELETED), reset
+    with a new id (as when it wraps or is recreated), or deactivated.
+
+Each has the same ioctl interface as journalcmd.Volume, so the results go
+through the same decoding and processing code as for a live volume.  A
+volume is used in place of a live one by setting Journal.open_volume.
+
+Example (capture a run on Windows, then replay it anywhere):
+
+journal.py --capture C.usncap C: C:/temp/journal
+journal.py --replay C.usncap C: /tmp/journal
+"""
+
+import struct
+import cPickle
+import bisect
+
+from journalcmd import *
+
+
+class CapturingVolume(object):
+    """A volume which records each request and result to a capture file."""
+
+    def __init__(self, volume, filename):
+        self.volume = volume
+        self.file = open(filename, 'wb')
+
+    def ioctl(self, code, inp, outlen):
+        try:
+            buf = self.volume.ioctl(code, inp, outlen)
+        except VolumeError, ex:
+            cPickle.dump((code, inp, outlen, None, ex.winerror), self.file, cPickle.HIGHEST_PROTOCOL)
+            raise
+        cPickle.dump((code, inp, outlen, buf, None), self.file, cPickle.HIGHEST_PROTOCOL)
+        return buf
+
+    def close(self):
+        self.file.close()
+        self.volume.close()
+
+
+class ReplayVolume(object):
+    """A volume which answers requests from a capture file.  Results for the
+    same request are given in the order they were captured; the last one is
+    repeated if the request is made more often than it was captured."""
+
+    def __init__(self, filename):
+        self.results = {}
+        f = open(filename, 'rb')
+        while True:
+            try:
+                code, inp, outlen, buf, winerror = cPickle.load(f)
+            except EOFError:
+                break
+            self.results.setdefault((code, inp), []).append((buf, winerror))
+        f.close()
+
+    def ioctl(self, code, inp, outlen):
+        try:
+            results = self.results[code, inp]
+        except KeyError:
+            raise VolumeError(ERROR_INVALID_PARAMETER, 'Request not in capture')
+        if len(results) > 1:
+            buf, winerror = results.pop(0)
+        else:
+            buf, winerror = results[0]
+        if winerror is not None:
+            raise VolumeError(winerror)
+        return buf
+
+    def close(self):
+        pass
+
+
+ROOT_FRN = 0x0005000000000005
+FIRST_FRN_INDEX = 0x40
+FRN_INDEX_MASK = 0xFFFFFFFFFFFF
+FILE_RECORD_SIZE = 1024
+
+
+class SyntheticVolume(object):
+    """A simulated volume with a USN journal."""
+
+    def __init__(self):
+        self.files = {}
+        self.next_index = FIRST_FRN_INDEX
+        self.journal_active = True
+        self.journal_id = 1
+        self.records = []
+        self.record_usns = []
+        self.first_usn = 0
+        self.next_usn = 0
+        self.mft_order = None
+
+    def close(self):
+        pass
+
+    def log(self, frn, parent_frn, reason, attributes, name):
+        record = encode_usn_record(frn, parent_frn, self.next_usn, reason, attributes, name)
+        self.records.append((self.next_usn, reason, record))
+        self.record_usns.append(self.next_usn)
+        self.next_usn += len(record)
+
+    def log_change(self, frn, reason):
+        parent_frn, name, attributes, usn = self.files[frn]
+        self.files[frn][3] = self.next_usn
+        self.log(frn, parent_frn, reason, attributes, name)
+
+    def create(self, parent_frn, name, is_dir=False):
+        """Create a file or directory, and return its FRN."""
+        frn = (1 << 48) | self.next_index
+        self.next_index += 1
+        attributes = FILE_ATTRIBUTE_DIRECTORY if is_dir else 0
+        self.files[frn] = [parent_frn, name, attributes, self.next_usn]
+        self.mft_order = None
+        self.log_change(frn, USN_REASON_FILE_CREATE)
+        self.log_change(frn, USN_REASON_FILE_CREATE | USN_REASON_CLOSE)
+        return frn
+
+    def write(self, frn):
+        self.log_change(frn, USN_REASON_DATA_EXTEND)
+        self.log_change(frn, USN_REASON_DATA_EXTEND | USN_REASON_CLOSE)
+
+    def rename(self, frn, parent_frn, name):
+        self.log_change(frn, USN_REASON_RENAME_OLD_NAME)
+        self.files[frn][0] = parent_frn
+        self.files[frn][1] = name
+        self.log_change(frn, USN_REASON_RENAME_NEW_NAME)
+        self.log_change(frn, USN_REASON_RENAME_NEW_NAME | USN_REASON_CLOSE)
+
+    def delete(self, frn):
+        self.log_change(frn, USN_REASON_FILE_DELETE | USN_REASON_CLOSE)
+        del self.files[frn]
+        self.mft_order = None
+
+    def truncate_journal(self, usn=None):
+        """Discard the journal records before usn (by default, all of them)."""
+        if usn is None:
+            usn = self.next_usn
+        i = bisect.bisect_left(self.record_usns, usn)
+        del self.records[:i]
+        del self.record_usns[:i]
+        self.first_usn = usn
+
+    def reset_journal(self):
+        """Start a new journal, as when it is deleted and recreated."""
+        self.journal_id += 1
+        self.records = []
+        self.record_usns = []
+        self.first_usn = self.next_usn
+
+    def deactivate_journal(self):
+        self.journal_active = False
+
+    def ioctl(self, code, inp, outlen):
+        if code == FSCTL_QUERY_USN_JOURNAL:
+            return self.query_journal()
+        elif code == FSCTL_CREATE_USN_JOURNAL:
+            if not self.journal_active:
+                self.journal_active = True
+                self.reset_journal()
+            return ''
+        elif code == FSCTL_GET_NTFS_VOLUME_DATA:
+            return self.get_ntfs_volume_data()
+        elif code == FSCTL_READ_USN_JOURNAL:
+            return self.read_journal(inp, outlen)
+        elif code == FSCTL_ENUM_USN_DATA:
+            return self.enum_usn_data(inp, outlen)
+        raise VolumeError(ERROR_INVALID_PARAMETER, 'Unsupported request 0x%08x' % code)
+
+    def query_journal(self):
+        if not self.journal_active:
+            raise VolumeError(ERROR_JOURNAL_NOT_ACTIVE)
+        return struct.pack(USN_JOURNAL_DATA_FORMAT, self.journal_id, self.first_usn, self.next_usn,
+                0, self.next_usn, JOURNAL_MAX_SIZE, JOURNAL_ALLOCATION_DELTA)
+
+    def get_ntfs_volume_data(self):
+        mft_length = self.next_index * FILE_RECORD_SIZE
+        return struct.pack(NTFS_VOLUME_DATA_FORMAT, 0, 0, 0, 0, 0, 512, 4096,
+                FILE_RECORD_SIZE, 0, mft_length, 0, 0, 0, 0)
+
+    def read_journal(self, inp, outlen):
+        start_usn, reason_mask, return_only_on_close, timeout, bytes_to_wait_for, journal_id = \
+                struct.unpack(READ_USN_JOURNAL_DATA_FORMAT, inp)
+        if not self.journal_active:
+            raise VolumeError(ERROR_JOURNAL_NOT_ACTIVE)
+        if journal_id != self.journal_id:
+            raise VolumeError(ERROR_INVALID_PARAMETER)
+        if start_usn == 0:
+            start_usn = self.first_usn
+        if start_usn < self.first_usn:
+            raise VolumeError(ERROR_JOURNAL_ENTRY_DELETED)
+
+        bufs = []
+        size = 8
+        next_usn = self.next_usn
+        for i in xrange(bisect.bisect_left(self.record_usns, start_usn), len(self.records)):
+            usn, reason, record = self.records[i]
+            if not reason & reason_mask:
+                continue
+            if size + len(record) > outlen:
+                next_usn = usn
+                break
+            bufs.append(record)
+            size += len(record)
+        return struct.pack('<Q', next_usn) + ''.join(bufs)
+
+    def enum_usn_data(self, inp, outlen):
+        start_frn, low_usn, high_usn = struct.unpack(MFT_ENUM_DATA_FORMAT, inp)
+        start_index = start_frn & FRN_INDEX_MASK
+        bufs = []
+        size = 8
+        next_index = None
+        if self.mft_order is None:
+            self.mft_order = sorted((f & FRN_INDEX_MASK, f) for f in self.files)
+        for i in xrange(bisect.bisect_left(self.mft_order, (start_index, 0)), len(self.mft_order)):
+            index, frn = self.mft_order[i]
+            parent_frn, name, attributes, usn = self.files[frn]
+            if not low_usn <= usn <= high_usn:
+                continue
+            record = encode_usn_record(frn, parent_frn, usn, 0, attributes, name)
+            if size + len(record) > outlen:
+                break
+            bufs.append(record)
+            size += len(record)
+            next_index = index + 1
+        if next_index is None:
+            raise VolumeError(ERROR_HANDLE_EOF)
+        return struct.pack('<Q', next_index) + ''.join(bufs)
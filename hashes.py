@@ -0,0 +1,157 @@
+"""Content hashes, selectable by name.
+
+Any algorithm known to hashlib can be used (md5, sha1, sha256, ...), as
+well as blake2b if hashlib or the pyblake2 module provides it.
+
+Prefixing a name with "tree-" (e.g. tree-blake2b) gives a tree hash: the
+contents are split into CHUNK_SIZE chunks which are hashed in parallel on
+a pool of threads (hashlib releases the GIL while hashing), and the result
+is the hash of the list of chunk digests.
+"""
+
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_ALGORITHM = "md5"
+TREE_PREFIX = "tree-"
+
+CHUNK_SIZE = 4*1024*1024
+THREADS = 4
+
+BUFFER_SIZE = 1024*1024
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+
+pool = None
+
+def get_pool():
+    global pool
+    if pool is None:
+        pool = ThreadPool(THREADS)
+    return pool
+
+
+def new_simple(algorithm):
+    if algorithm == 'blake2b' and blake2b is not None:
+        return blake2b()
+    return hashlib.new(algorithm)
+
+
+def hash_chunk(algorithm, bufs):
+    h = new_simple(algorithm)
+    for buf in bufs:
+        h.update(buf)
+    return h.digest()
+
+
+class TreeHash(object):
+    """A hash of the digests of each CHUNK_SIZE chunk of the contents."""
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.pending = []
+        self.pending_size = 0
+        self.results = []
+
+    def update(self, buf):
+        while len(buf) > 0:
+            part = buf[:CHUNK_SIZE - self.pending_size]
+            buf = buf[len(part):]
+            self.pending.append(part)
+            self.pending_size += len(part)
+            if self.pending_size == CHUNK_SIZE:
+                self.submit()
+
+    def submit(self):
+        # Don't let unhashed chunks pile up faster than they can be hashed.
+        if len(self.results) >= 2*THREADS:
+            self.results[-2*THREADS].wait()
+        self.results.append(get_pool().apply_async(hash_chunk, (self.algorithm, self.pending)))
+        self.pending = []
+        self.pending_size = 0
+
+    def hexdigest(self):
+        if self.pending_size > 0 or len(self.results) == 0:
+            self.submit()
+        h = new_simple(self.algorithm)
+        for r in self.results:
+            h.update(r.get())
+        return h.hexdigest()
+
+
+class BlockHashes(object):
+    """The digests of each block_size block of the contents."""
+
+    def __init__(self, block_size, algorithm='md5'):
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.digests = []
+        self.block = None
+        self.block_len = 0
+
+    def update(self, buf):
+        while len(buf) > 0:
+            if self.block is None:
+                self.block = new_simple(self.algorithm)
+                self.block_len = 0
+            part = buf[:self.block_size - self.block_len]
+            buf = buf[len(part):]
+            self.block.update(part)
+            self.block_len += len(part)
+            if self.block_len == self.block_size:
+                self.digests.append(self.block.digest())
+                self.block = None
+
+    def get_digests(self):
+        if self.block is not None:
+            self.digests.append(self.block.digest())
+            self.block = None
+        return self.digests
+
+
+class MultiHash(object):
+    """Several hashes of the same contents, computed in one pass."""
+
+    def __init__(self, algorithms):
+        self.hashes = dict((a, new(a)) for a in algorithms)
+
+    def update(self, buf):
+        for h in self.hashes.itervalues():
+            h.update(buf)
+
+    def hexdigests(self):
+        return dict((a, h.hexdigest()) for a, h in self.hashes.iteritems())
+
+
+def new(algorithm):
+    if algorithm.startswith(TREE_PREFIX):
+        return TreeHash(algorithm[len(TREE_PREFIX):])
+    return new_simple(algorithm)
+
+
+def is_available(algorithm):
+    try:
+        new(algorithm).hexdigest()
+    except ValueError:
+        return False
+    return True
+
+
+def hash_file(algorithm, path):
+    f = open(path, 'rb')
+    h = new(algorithm)
+    while True:
+        buf = f.read(BUFFER_SIZE)
+        if len(buf) == 0:
+            break
+        h.update(buf)
+    f.close()
+    return h.hexdigest()
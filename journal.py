@@ -12,9 +12,12 @@ http://www.microsoft.com/msj/1099/journal2/journal2.aspx
 
 import sys
 import os
+import struct
 import cPickle
+from optparse import OptionParser
 
 from journalcmd import *
+import fakevolume
 
 
 def default_notifier(msg):
@@ -50,88 +53,381 @@ def get_ancestors(path):
     return ancestors
 
 
+FRNMAP_SUFFIX = '.frnmap'
+LOG_SUFFIX = '.log'
+
+# Compact the log into a new base when it has this many entries per entry in the map.
+COMPACT_RATIO = 0.25
+
+# Each table record is a FRN, its parent FRN, and the id of its name.  Big-endian, so
+# that the packed FRNs sort in the same order as the numbers.
+RECORD_FORMAT = '>QQI'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+FRN_FORMAT = '>Q'
+FRN_SIZE = struct.calcsize(FRN_FORMAT)
+
+# Merge pending entries into the table when there are this many, or an eighth of
+# the table size if that is larger.
+MERGE_MIN = 65536
+
+
 class FrnMap(object):
     """A map from FRNs to parent FRNs and names.  This is enough information to
-    translate a FRN to a path (as done in build_path)."""
+    translate a FRN to a path (as done in build_path).
+    
+    Entries are kept in a table of fixed-size records sorted by FRN, with each
+    name stored once in a name table.  New entries go into a small dict until
+    there are enough of them to merge into the table.
+    
+    The map is saved as a base snapshot, plus a log of the changes made since
+    it was saved.  Each save appends just the latest changes to the log, and
+    the log is compacted into a new base once it gets large."""
     
     def __init__(self):
-        self.map = {}
+        self.table = bytearray()
+        self.names = []
+        self.name_ids = {}
+        self.pending = {}
+        self.count = 0
+        self.changes = []
+        self.log_entries = 0
+        self.has_base = False
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, frn):
+        return self.get(frn) is not None
+
+    def get_name_id(self, name):
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            name_id = len(self.names)
+            self.names.append(name)
+            self.name_ids[name] = name_id
+            return name_id
+
+    def find(self, frn):
+        """Return the position in the table where frn is, or would be inserted."""
+        key = struct.pack(FRN_FORMAT, frn)
+        table = self.table
+        lo = 0
+        hi = len(table) // RECORD_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = mid * RECORD_SIZE
+            if table[pos:pos+FRN_SIZE] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_record(self, frn):
+        """Return the parent FRN and name id for frn, or None."""
+        if frn in self.pending:
+            return self.pending[frn]
+        i = self.find(frn)
+        if i * RECORD_SIZE >= len(self.table):
+            return None
+        record_frn, parent_frn, name_id = struct.unpack_from(RECORD_FORMAT, self.table, i * RECORD_SIZE)
+        if record_frn != frn:
+            return None
+        return parent_frn, name_id
+
+    def get(self, frn):
+        record = self.get_record(frn)
+        if record is None:
+            return None
+        return record[0], self.names[record[1]]
+
+    def merge(self):
+        """Merge the pending entries into the table."""
+        old = self.table
+        new = bytearray()
+        pos = 0
+        for frn, (parent_frn, name_id) in sorted(self.pending.iteritems()):
+            i = self.find(frn)
+            if i * RECORD_SIZE < len(old) and struct.unpack_from(FRN_FORMAT, old, i * RECORD_SIZE)[0] == frn:
+                struct.pack_into(RECORD_FORMAT, old, i * RECORD_SIZE, frn, parent_frn, name_id)
+                continue
+            new += old[pos * RECORD_SIZE:i * RECORD_SIZE]
+            new += struct.pack(RECORD_FORMAT, frn, parent_frn, name_id)
+            pos = i
+        new += old[pos * RECORD_SIZE:]
+        self.table = new
+        self.pending = {}
+
+    def set_entry(self, frn, parent_frn, name):
+        """Set an entry without recording it as a change.  Returns True if the
+        entry was different."""
+        name_id = self.get_name_id(name)
+        record = self.get_record(frn)
+        if record == (parent_frn, name_id):
+            return False
+        if record is None:
+            self.count += 1
+        self.pending[frn] = parent_frn, name_id
+        if len(self.pending) >= max(MERGE_MIN, self.count // 8):
+            self.merge()
+        return True
+
+    def set(self, frn, parent_frn, name):
+        if self.set_entry(frn, parent_frn, name):
+            self.changes.append((frn, parent_frn, name))
+
+    def items(self):
+        self.merge()
+        for i in xrange(len(self.table) // RECORD_SIZE):
+            frn, parent_frn, name_id = struct.unpack_from(RECORD_FORMAT, self.table, i * RECORD_SIZE)
+            yield frn, (parent_frn, self.names[name_id])
 
     def load(self, filename):
         f = open(filename, 'rb')
-        self.map.update(cPickle.load(f))
+        obj = cPickle.load(f)
+        f.close()
+        if isinstance(obj, dict):
+            # A base saved as a plain dict.
+            for frn, (parent_frn, name) in obj.iteritems():
+                self.set_entry(frn, parent_frn, name)
+        else:
+            table, names = obj
+            self.table = bytearray(table)
+            self.names = names
+            self.name_ids = dict((name, i) for i, name in enumerate(names))
+            self.pending = {}
+            self.count = len(self.table) // RECORD_SIZE
+        self.has_base = True
+        
+        self.log_entries = 0
+        try:
+            f = open(filename + LOG_SUFFIX, 'rb')
+        except IOError:
+            return
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            pos = f.tell()
+            try:
+                changes = cPickle.load(f)
+            except (EOFError, cPickle.UnpicklingError, ValueError, IndexError):
+                if pos < size:
+                    # A partly written last batch (which may just be cut short,
+                    # giving EOFError).  The recorded USN is from before it, so
+                    # its changes will be read from the journal again; cut it
+                    # off so that later batches aren't appended after it.
+                    f.close()
+                    f = open(filename + LOG_SUFFIX, 'r+b')
+                    f.truncate(pos)
+                break
+            for frn, parent_frn, name in changes:
+                self.set_entry(frn, parent_frn, name)
+            self.log_entries += len(changes)
         f.close()
 
     def save(self, filename):
+        """Save the whole map as a new base, and start a new log."""
+        self.merge()
         f = open(filename, 'wb')
-        cPickle.dump(self.map, f)
+        cPickle.dump((str(self.table), self.names), f, cPickle.HIGHEST_PROTOCOL)
         f.close()
+        f = open(filename + LOG_SUFFIX, 'wb')
+        f.close()
+        self.changes = []
+        self.log_entries = 0
+        self.has_base = True
 
-    def set(self, frn, parent_frn, name):
-        self.map[frn] = parent_frn, name
+    def save_changes(self, filename):
+        """Append the changes since the last save to the log."""
+        if not self.has_base or self.log_entries + len(self.changes) > COMPACT_RATIO * len(self):
+            self.save(filename)
+            return
+        
+        if len(self.changes) == 0:
+            return
+        
+        f = open(filename + LOG_SUFFIX, 'ab')
+        cPickle.dump(self.changes, f, cPickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.log_entries += len(self.changes)
+        self.changes = []
 
     def build_path(self, frn):
-        if frn not in self.map:
-            return ''
-        parent_frn, name = self.map[frn]
-        return self.build_path(parent_frn) + '/' + name
+        names = []
+        while True:
+            record = self.get_record(frn)
+            if record is None:
+                break
+            parent_frn, name_id = record
+            names.append(self.names[name_id])
+            if parent_frn == frn:
+                break
+            frn = parent_frn
+        names.append('')
+        names.reverse()
+        return '/'.join(names)
+
+
+# Most changes tracked individually before they are coalesced into whole directories.
+MAX_CHANGES = 1000000
+
+# Most whole directories tracked before everything is considered changed.
+MAX_CHANGED_DIRS = 100000
 
 
 class Journal(object):
+    """Tracks changes to a volume through its USN journal.
+    
+    Changes are tracked individually up to a budget of max_changes.  Past it,
+    the directories with the most changes are marked as wholly changed instead,
+    and if too many directories are marked, everything is marked as changed."""
     
     def __init__(self, drive):
         self.drive = drive
+        self.max_changes = MAX_CHANGES
+        self.max_changed_dirs = MAX_CHANGED_DIRS
+        self.open_volume = open_volume
         self.set_state((None, None, {}))
+        self.clear_changes()
+
+    def clear_changes(self):
+        self.changed = set()
+        self.changed_dirs = set()
+        self.affected_frns = set()
+        self.affected_dir_paths = None
+        self.changed_dir_paths = None
+        self.everything_changed = False
 
     def process_usn(self, tup, fn):
-        if tup[10] & win32file.FILE_ATTRIBUTE_DIRECTORY:
+        if tup[10] & FILE_ATTRIBUTE_DIRECTORY:
             self.frn_to_dir_map.set(tup[3], tup[4], fn)
         
+        if self.everything_changed:
+            return
+        
         parent_frn = tup[4]
-        parent_path = self.frn_to_dir_map.build_path(parent_frn)
-        try:
-            path = parent_path + '/' + fn
-        except UnicodeEncodeError, ex:
-            print >>sys.stderr, "Error outputting file name:", ex
+        if parent_frn not in self.changed_dirs:
+            self.changed.add((parent_frn, os.path.normcase(fn)))
+            if len(self.changed) > self.max_changes:
+                self.coalesce()
+                if self.everything_changed:
+                    return
+        
+        # Mark the parent and its ancestors as affected, stopping at the first
+        # that already is.
+        frn = parent_frn
+        while frn not in self.affected_frns:
+            self.affected_frns.add(frn)
+            entry = self.frn_to_dir_map.get_record(frn)
+            if entry is None:
+                break
+            frn = entry[0]
+        self.affected_dir_paths = None
+
+    def coalesce(self):
+        """Reduce the individual changes to half the budget, by marking the
+        directories with the most changes as wholly changed."""
+        counts = {}
+        for parent_frn, name in self.changed:
+            counts[parent_frn] = counts.get(parent_frn, 0) + 1
+        remaining = len(self.changed)
+        for parent_frn in sorted(counts, key=counts.get, reverse=True):
+            if remaining <= self.max_changes // 2:
+                break
+            self.changed_dirs.add(parent_frn)
+            remaining -= counts[parent_frn]
+        
+        if len(self.changed_dirs) > self.max_changed_dirs:
+            self.mark_everything_changed()
             return
-        for p in get_ancestors(normalise(path))[:-1]:
-            if p not in self.affected_dirs:
-                self.affected_dirs.add(p)
-        self.changed_paths.add(normalise(path))
+        
+        self.changed = set((p, n) for p, n in self.changed if p not in self.changed_dirs)
+        self.changed_dir_paths = None
+
+    def mark_everything_changed(self):
+        self.everything_changed = True
+        self.changed = set()
+        self.changed_dirs = set()
+        self.affected_frns = set()
+        self.affected_dir_paths = None
+        self.changed_dir_paths = None
 
     def get_state(self):
-        return self.journal_id, self.last_usn, self.frn_to_dir_map.map
+        return self.journal_id, self.last_usn, dict(self.frn_to_dir_map.items())
 
     def set_state(self, state):
         self.journal_id = state[0]
         self.last_usn = state[1]
         self.frn_to_dir_map = FrnMap()
-        self.frn_to_dir_map.map.update(state[2])
+        for frn, (parent_frn, name) in state[2].iteritems():
+            self.frn_to_dir_map.set_entry(frn, parent_frn, name)
     
     def load_state(self, filename):
+        """Load the state saved by save_state.  Older state files have the whole
+        dir map in them, rather than in a separate file."""
         f = open(filename, 'rb')
         obj = cPickle.load(f)
         f.close()
-        self.set_state(obj)
+        if obj[2] is not None:
+            self.set_state(obj)
+            return
+        
+        frn_map = FrnMap()
+        frn_map.load(filename + FRNMAP_SUFFIX)
+        self.set_state((obj[0], obj[1], {}))
+        self.frn_to_dir_map = frn_map
         
     def save_state(self, filename):
-        obj = self.get_state()
+        """Save the state, with the dir map in its own file.  The map is saved
+        first, so that the recorded USN is never ahead of it."""
+        self.frn_to_dir_map.save_changes(filename + FRNMAP_SUFFIX)
+        obj = self.journal_id, self.last_usn, None
         f = open(filename, 'wb')
         cPickle.dump(obj, f)
         f.close()
 
+    def get_dir_path(self, frn):
+        path = normalise(self.frn_to_dir_map.build_path(frn))
+        if path == '':
+            path = '/'
+        return path
+
+    def get_affected_dir_paths(self):
+        """Return a map from each affected directory's path to its FRNs.  FRNs
+        which are not in the dir map all have the root path."""
+        if self.affected_dir_paths is None:
+            self.affected_dir_paths = {}
+            for frn in self.affected_frns:
+                self.affected_dir_paths.setdefault(self.get_dir_path(frn), []).append(frn)
+        return self.affected_dir_paths
+
+    def get_changed_dir_paths(self):
+        if self.changed_dir_paths is None:
+            self.changed_dir_paths = set(self.get_dir_path(frn) for frn in self.changed_dirs)
+        return self.changed_dir_paths
+
     def get_changed_paths(self):
-        return self.changed_paths
+        """Return the paths of the changes.  A path ending in / means everything
+        within it has changed."""
+        if self.everything_changed:
+            return set(['/'])
+        paths = set(p.rstrip('/') + '/' for p in self.get_changed_dir_paths())
+        for parent_frn, name in self.changed:
+            paths.add(normalise(self.get_dir_path(parent_frn) + '/' + name))
+        return paths
 
-    def process(self, notifier=default_notifier):
+    def process(self, notifier=default_notifier, clear=True):
+        """Read the journal from the last recorded USN.  Unless clear is false,
+        only the changes found in this call are kept."""
         notifier('Opening volume %s' % self.drive)
-        volh = open_volume(self.drive)
+        volh = self.open_volume(self.drive)
         
         notifier('Querying journal')
         try:
             tup = query_journal(volh)
-        except pywintypes.error, ex:
-            if ex.winerror == 1179:   # ERROR_JOURNAL_NOT_ACTIVE
+        except VolumeError, ex:
+            if ex.winerror == ERROR_JOURNAL_NOT_ACTIVE:
                 notifier('Creating new journal')
                 create_journal(volh)
                 notifier('Re-querying')
@@ -152,8 +448,14 @@ class Journal(object):
             self.last_usn = first_usn
             self.replay_all = True
         
-        self.changed_paths = set()
-        self.affected_dirs = set()
+        if clear:
+            self.clear_changes()
+        
+        if self.replay_all:
+            # There's no telling what changed before the recorded USN, so the
+            # records are only needed to rebuild the dir map.
+            notifier('Treating everything as changed')
+            self.mark_everything_changed()
 
         if self.replay_all:
             tup = get_ntfs_volume_data(volh)
@@ -180,7 +482,8 @@ class Journal(object):
         start_usn = self.last_usn
         notifier('Replaying journal from USN 0x%016x to 0x%016x' % (start_usn, next_usn))
         last_pct = 0
-        for tup,fn in generate_journal(volh, self.journal_id, start_usn):
+        reason_mask, dirs_only = self.get_record_filter()
+        for tup,fn in generate_journal(volh, self.journal_id, start_usn, reason_mask, dirs_only):
             if self.replay_all or self.last_usn < tup[5]:
                 self.process_usn(tup, fn)
                 self.last_usn = tup[5]
@@ -192,17 +495,37 @@ class Journal(object):
         notifier('Closing volume')
         close_volume(volh)
     
+    def get_record_filter(self):
+        """Return the reason mask and whether only directories are wanted.  Once
+        everything has changed, only records that can change the dir map are."""
+        if self.everything_changed:
+            return DIR_MAP_CHANGES, True
+        return PATH_CHANGES, False
+
     def affected(self, path):
         """Could this path possibly have changed according to the journal?"""
         
+        if self.everything_changed:
+            return True
+        
         path = normalise(path)
         
-        if path in self.affected_dirs:
+        changed_dir_paths = self.get_changed_dir_paths()
+        for p in get_ancestors(path):
+            if p in changed_dir_paths:
+                return True
+        
+        affected_dir_paths = self.get_affected_dir_paths()
+        if path in affected_dir_paths:
             return True
         
         for p in get_ancestors(path):
-            if p in self.changed_paths:
-                return True
+            parent_path, name = p.rsplit('/', 1)
+            if name == '':
+                continue
+            for parent_frn in affected_dir_paths.get(parent_path or '/', []):
+                if (parent_frn, name) in self.changed:
+                    return True
         
         return False
 
@@ -210,15 +533,29 @@ class Journal(object):
 def main(argv=None):
     if argv is None:
         argv = sys.argv
-    drive = argv[1]
-    journal_filename = argv[2]
+    
+    parser = OptionParser(usage="%prog [options] DRIVE JOURNAL_FILE [TARGET_DIR]")
+    parser.add_option("--capture", default=None, action='store',
+                      help="record the volume's FSCTL results to this file")
+    parser.add_option("--replay", default=None, action='store',
+                      help="read the volume's FSCTL results from this file instead of the drive")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) < 2:
+        parser.error('Drive and journal file arguments required')
+    
+    drive = args[0]
+    journal_filename = args[1]
     try:
-        target_dir = argv[3]
+        target_dir = args[2]
     except IndexError:
         target_dir = os.getcwd()
     
     print 'Opening journal'
     j = Journal(drive)
+    if options.capture is not None:
+        j.open_volume = lambda drive: fakevolume.CapturingVolume(open_volume(drive), options.capture)
+    elif options.replay is not None:
+        j.open_volume = lambda drive: fakevolume.ReplayVolume(options.replay)
     try:
         j.load_state(journal_filename)
     except IOError:
@@ -227,7 +564,7 @@ def main(argv=None):
     print 'Processing'
     j.process(notifier=print_notifier)
     
-    print 'Changed paths:'
+    print 'Changed paths (those ending in / changed entirely):'
     for p in sorted(j.get_changed_paths()):
         try:
             print p
@@ -1,95 +1,189 @@
+"""Access to the NTFS USN journal, through FSCTL requests on a volume.
+
+All requests go through a volume object's ioctl method, so that a volume can
+be replaced by one that captures or replays the raw result buffers (see
+fakevolume.py).  Structures are packed with standard sizes, so the decoding
+works on any platform; only Volume needs pywin32.
+"""
+
 import struct
-import win32file
-import winioctlcon
-import win32api
-import winerror
-import pywintypes
+
+try:
+    import win32file
+    import win32api
+    import pywintypes
+except ImportError:
+    win32file = None
 
 USN_BUFFER_SIZE = 4096
 JOURNAL_MAX_SIZE = 16*1048576
 JOURNAL_ALLOCATION_DELTA = 65536
-   
+
+FSCTL_GET_NTFS_VOLUME_DATA = 0x00090064
+FSCTL_ENUM_USN_DATA = 0x000900b3
+FSCTL_READ_USN_JOURNAL = 0x000900bb
+FSCTL_CREATE_USN_JOURNAL = 0x000900e7
+FSCTL_READ_FILE_USN_DATA = 0x000900eb
+FSCTL_QUERY_USN_JOURNAL = 0x000900f4
+
+USN_REASON_DATA_OVERWRITE = 0x00000001
+USN_REASON_DATA_EXTEND = 0x00000002
+USN_REASON_DATA_TRUNCATION = 0x00000004
+USN_REASON_FILE_CREATE = 0x00000100
+USN_REASON_FILE_DELETE = 0x00000200
+USN_REASON_RENAME_OLD_NAME = 0x00001000
+USN_REASON_RENAME_NEW_NAME = 0x00002000
+USN_REASON_BASIC_INFO_CHANGE = 0x00008000
+USN_REASON_CLOSE = 0x80000000
+
+FILE_ATTRIBUTE_DIRECTORY = 0x00000010
+
+ERROR_HANDLE_EOF = 38
+ERROR_INVALID_PARAMETER = 87
+ERROR_JOURNAL_NOT_ACTIVE = 1179
+ERROR_JOURNAL_ENTRY_DELETED = 1181
+
+USN_JOURNAL_DATA_FORMAT = '<QQQQQQQ'
+NTFS_VOLUME_DATA_FORMAT = '<qqqqqLLLLqqqqq'
+USN_RECORD_FORMAT = '<LHHQQQQLLLLHH'
+READ_USN_JOURNAL_DATA_FORMAT = '<QLLQQQ'
+MFT_ENUM_DATA_FORMAT = '<QQQ'
+CREATE_USN_JOURNAL_DATA_FORMAT = '<QQ'
+
+
+def is_available():
+    """Can live volumes be opened on this system?"""
+    return win32file is not None
+
+
+class VolumeError(Exception):
+    """A failed FSCTL request, with its Windows error code."""
+
+    def __init__(self, winerror, message=None):
+        Exception.__init__(self, winerror, message)
+        self.winerror = winerror
+
+
+class Volume(object):
+    """A live NTFS volume."""
+
+    def __init__(self, drive):
+        self.handle = win32file.CreateFile('\\\\.\\' + drive, win32file.GENERIC_READ,
+                win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE, None, 
+                win32file.OPEN_EXISTING, win32file.FILE_ATTRIBUTE_NORMAL, None)
+
+    def ioctl(self, code, inp, outlen):
+        try:
+            return win32file.DeviceIoControl(self.handle, code, inp, outlen)
+        except pywintypes.error, ex:
+            raise VolumeError(ex.winerror, ex.strerror)
+
+    def close(self):
+        win32file.CloseHandle(self.handle)
+
 def open_volume(drive):
-    volh = win32file.CreateFile('\\\\.\\' + drive, win32file.GENERIC_READ,
-            win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE, None, 
-            win32file.OPEN_EXISTING, win32file.FILE_ATTRIBUTE_NORMAL, None)
-    return volh
+    return Volume(drive)
 
 def close_volume(volh):
-        win32file.CloseHandle(volh)
+    volh.close()
 
 def create_journal(volh):
-    inp = struct.pack('QQ', JOURNAL_MAX_SIZE, JOURNAL_ALLOCATION_DELTA)
-    win32file.DeviceIoControl(volh, winioctlcon.FSCTL_CREATE_USN_JOURNAL, inp, None)
+    inp = struct.pack(CREATE_USN_JOURNAL_DATA_FORMAT, JOURNAL_MAX_SIZE, JOURNAL_ALLOCATION_DELTA)
+    volh.ioctl(FSCTL_CREATE_USN_JOURNAL, inp, None)
 
 def query_journal(volh):
-    fmt = 'QQQQQQQ'
+    fmt = USN_JOURNAL_DATA_FORMAT
     len = struct.calcsize(fmt)
-    buf = win32file.DeviceIoControl(volh, winioctlcon.FSCTL_QUERY_USN_JOURNAL, None, len)
+    buf = volh.ioctl(FSCTL_QUERY_USN_JOURNAL, None, len)
     tup = struct.unpack(fmt, buf)
     return tup
 
 def get_ntfs_volume_data(volh):
-    fmt = 'qqqqqLLLLqqqqq'
+    fmt = NTFS_VOLUME_DATA_FORMAT
     len = struct.calcsize(fmt)
-    buf = win32file.DeviceIoControl(volh, winioctlcon.FSCTL_GET_NTFS_VOLUME_DATA, None, len)
+    buf = volh.ioctl(FSCTL_GET_NTFS_VOLUME_DATA, None, len)
     tup = struct.unpack(fmt, buf)
     return tup
 
 def get_volume_info(drive):
     return win32api.GetVolumeInformation('\\\\.\\' + drive + '\\')
 
+USN_RECORD_ATTRIBUTES_OFFSET = 52
+
+def encode_usn_record(frn, parent_frn, usn, reason, attributes, name, timestamp=0):
+    """Pack a USN_RECORD (version 2), as returned by the journal and MFT requests."""
+    name_buf = name.encode('UTF-16-LE')
+    headlen = struct.calcsize(USN_RECORD_FORMAT)
+    recordlen = (headlen + len(name_buf) + 7) & ~7
+    head = struct.pack(USN_RECORD_FORMAT, recordlen, 2, 0, frn, parent_frn, usn, timestamp,
+            reason, 0, 0, attributes, len(name_buf), headlen)
+    return head + name_buf + '\0' * (recordlen - headlen - len(name_buf))
+
 def decode_usn_record(buf):
-    outfmt = 'LHHQQQQLLLLHH'
+    outfmt = USN_RECORD_FORMAT
     outlen = struct.calcsize(outfmt)
     tup = struct.unpack(outfmt, buf[:outlen])
     recordlen = tup[0]
     filenamelen = tup[11]
     filenameoffset = tup[12]
     name1 = buf[filenameoffset:filenameoffset+filenamelen]
-    name = name1.decode('UTF-16', 'replace')
+    name = name1.decode('UTF-16-LE', 'replace')
     return recordlen, tup, name
 
-def decode_usn_data(buf):
-    headfmt = 'Q'
+def decode_usn_data(buf, dirs_only=False):
+    headfmt = '<Q'
     headlen = struct.calcsize(headfmt)
     head_usn = struct.unpack(headfmt, buf[:headlen])[0]
     buf = buf[headlen:]
     tups = []
     while len(buf) > 0:
+        if dirs_only:
+            # Skip other records without decoding their names.
+            recordlen = struct.unpack_from('<L', buf, 0)[0]
+            attributes = struct.unpack_from('<L', buf, USN_RECORD_ATTRIBUTES_OFFSET)[0]
+            if not attributes & FILE_ATTRIBUTE_DIRECTORY:
+                buf = buf[recordlen:]
+                continue
         recordlen, tup, name = decode_usn_record(buf)
         tups.append((tup, name))
         buf = buf[recordlen:]
     return head_usn, tups
 
-ALL_INTERESTING_CHANGES = (winioctlcon.USN_REASON_BASIC_INFO_CHANGE | winioctlcon.USN_REASON_CLOSE
-        | winioctlcon.USN_REASON_DATA_EXTEND | winioctlcon.USN_REASON_DATA_OVERWRITE | winioctlcon.USN_REASON_DATA_TRUNCATION
-        | winioctlcon.USN_REASON_FILE_CREATE | winioctlcon.USN_REASON_FILE_DELETE
-        | winioctlcon.USN_REASON_RENAME_NEW_NAME | winioctlcon.USN_REASON_RENAME_OLD_NAME)
+ALL_INTERESTING_CHANGES = (USN_REASON_BASIC_INFO_CHANGE | USN_REASON_CLOSE
+        | USN_REASON_DATA_EXTEND | USN_REASON_DATA_OVERWRITE | USN_REASON_DATA_TRUNCATION
+        | USN_REASON_FILE_CREATE | USN_REASON_FILE_DELETE
+        | USN_REASON_RENAME_NEW_NAME | USN_REASON_RENAME_OLD_NAME)
 
-def read_journal(volh, journal_id, first_usn):
-    reason_mask = ALL_INTERESTING_CHANGES
-    inp = struct.pack('QLLQQQ', first_usn, reason_mask, 0, 0, 0, journal_id)
-    buf = win32file.DeviceIoControl(volh, winioctlcon.FSCTL_READ_USN_JOURNAL, inp, USN_BUFFER_SIZE)
-    return decode_usn_data(buf)
+# Changes that can affect a path's contents or existence.  Close records without
+# any of these carry no information.
+PATH_CHANGES = ALL_INTERESTING_CHANGES & ~USN_REASON_CLOSE
+
+# Changes that can add an entry to a dir map.
+DIR_MAP_CHANGES = USN_REASON_FILE_CREATE | USN_REASON_RENAME_NEW_NAME
+
+def read_journal(volh, journal_id, first_usn, reason_mask=ALL_INTERESTING_CHANGES, dirs_only=False):
+    inp = struct.pack(READ_USN_JOURNAL_DATA_FORMAT, first_usn, reason_mask, 0, 0, 0, journal_id)
+    buf = volh.ioctl(FSCTL_READ_USN_JOURNAL, inp, USN_BUFFER_SIZE)
+    return decode_usn_data(buf, dirs_only)
 
 def enum_usn_data(volh, first_frn, low_usn, high_usn):
-    inp = struct.pack('QQQ', first_frn, low_usn, high_usn)
+    inp = struct.pack(MFT_ENUM_DATA_FORMAT, first_frn, low_usn, high_usn)
     try:
-        buf = win32file.DeviceIoControl(volh, winioctlcon.FSCTL_ENUM_USN_DATA, inp, USN_BUFFER_SIZE)
-    except pywintypes.error, ex:
-        if ex.args[0] == winerror.ERROR_HANDLE_EOF:
+        buf = volh.ioctl(FSCTL_ENUM_USN_DATA, inp, USN_BUFFER_SIZE)
+    except VolumeError, ex:
+        if ex.winerror == ERROR_HANDLE_EOF:
             return None, []
         raise
-    head_usn = struct.unpack('Q', buf[:8])[0]
     return decode_usn_data(buf)
 
-def generate_journal(volh, journal_id, first_usn):
+def generate_journal(volh, journal_id, first_usn, reason_mask=ALL_INTERESTING_CHANGES, dirs_only=False):
+    """Generate the journal's records from first_usn.  Only records with one of
+    the reasons in reason_mask (and for directories, if dirs_only) are generated."""
     while True:
         try:
-            first_usn, tups = read_journal(volh, journal_id, first_usn)
-        except pywintypes.error, ex:
-            if ex.winerror == 1181:   # ERROR_JOURNAL_ENTRY_DELETED
+            first_usn, tups = read_journal(volh, journal_id, first_usn, reason_mask, dirs_only)
+        except VolumeError, ex:
+            if ex.winerror == ERROR_JOURNAL_ENTRY_DELETED:
                 break
             raise
         if len(tups) == 0:
@@ -111,7 +205,7 @@ def read_file_usn(path):
     fileh = win32file.CreateFile(path, win32file.GENERIC_READ,
             win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE, None, 
             win32file.OPEN_EXISTING, win32file.FILE_ATTRIBUTE_NORMAL, None)
-    buf = win32file.DeviceIoControl(fileh, winioctlcon.FSCTL_READ_FILE_USN_DATA, None, USN_BUFFER_SIZE)
+    buf = win32file.DeviceIoControl(fileh, FSCTL_READ_FILE_USN_DATA, None, USN_BUFFER_SIZE)
     win32file.CloseHandle(fileh)
     recordlen, tups, name = decode_usn_record(buf)
     return tups, name
@@ -1,4 +1,5 @@
 import os
+import errno
 import struct
 import platform
 
@@ -18,9 +19,53 @@ if platform.system() == 'Windows':
             make_symlink(dest, src)
         except pywintypes.error, ex:
             raise OSError(ex)
+    
+    def reflink(src, dest):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported', dest)
+    
+    def get_file_info(path):
+        """Return the file's size, number of hard links, and an id shared by
+        all its links.  (Python 2's os.stat gives no link count or inode
+        number on Windows.)"""
+        try:
+            fileh = win32file.CreateFile(path, 0,
+                    win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE | win32file.FILE_SHARE_DELETE, None,
+                    win32file.OPEN_EXISTING, win32file.FILE_FLAG_BACKUP_SEMANTICS, None)
+            try:
+                info = win32file.GetFileInformationByHandle(fileh)
+            finally:
+                win32file.CloseHandle(fileh)
+        except pywintypes.error, ex:
+            raise OSError(ex)
+        attributes, ctime, atime, mtime, serial, size_high, size_low, nlink, index_high, index_low = info
+        return (size_high << 32) | size_low, nlink, (serial, index_high, index_low)
 
 else:
+    import fcntl
     from os import link, symlink
+    
+    FICLONE = 0x40049409
+    
+    def reflink(src, dest):
+        """Make dest a copy-on-write clone of src, sharing its blocks."""
+        f = open(src, 'rb')
+        try:
+            f2 = open(dest, 'wb')
+            try:
+                fcntl.ioctl(f2.fileno(), FICLONE, f.fileno())
+            except IOError, ex:
+                f2.close()
+                os.remove(dest)
+                raise OSError(ex.errno, ex.strerror, dest)
+            f2.close()
+        finally:
+            f.close()
+    
+    def get_file_info(path):
+        """Return the file's size, number of hard links, and an id shared by
+        all its links."""
+        st = os.stat(path)
+        return st.st_size, st.st_nlink, (st.st_dev, st.st_ino)
 
 
 def make_hardlink(dest_path, link_path):
@@ -0,0 +1,175 @@
+"""Pack-file storage for small files.
+
+Rather than giving each small file its own file in the snapshot, its
+contents are appended to a shared pack file in the packs directory of the
+target.  Contents are addressed by their hash, so each distinct content is
+stored only once across all snapshots.  The index maps a hash to the pack,
+offset and size where the contents can be found.
+
+Each snapshot has a catalog, mapping item paths to hashes, which stands in
+for the directory listing of the packed files in that snapshot.
+
+Example (list a snapshot's packed files, then extract one):
+
+packs.py C:/snapshots 20101103
+packs.py C:/snapshots 20101103 windows/win.ini C:/temp/win.ini
+"""
+
+import sys
+import os
+import os.path
+import cPickle
+import mmap
+
+
+PACKS_DIRNAME = "packs"
+INDEX_FILENAME = "index"
+CATALOG_SUFFIX = ".catalog"
+PACK_PREFIX = "pack-"
+
+MAX_PACK_SIZE = 256*1024*1024
+
+
+class PackStore(object):
+    """A set of pack files and their index, in the packs directory of a
+    backup target."""
+
+    def __init__(self, target):
+        self.path = os.path.join(target, PACKS_DIRNAME)
+        self.index = {}
+        self.pack_name = None
+        self.pack_file = None
+
+    def open(self):
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        try:
+            f = open(os.path.join(self.path, INDEX_FILENAME), 'rb')
+            self.index = cPickle.load(f)
+            f.close()
+        except IOError:
+            self.index = {}
+
+    def close(self):
+        if self.pack_file is not None:
+            self.pack_file.close()
+            self.pack_file = None
+            self.pack_name = None
+        f = open(os.path.join(self.path, INDEX_FILENAME), 'wb')
+        cPickle.dump(self.index, f)
+        f.close()
+
+    def get_pack_names(self):
+        names = [fn for fn in os.listdir(self.path) if fn.startswith(PACK_PREFIX)]
+        names.sort()
+        return names
+
+    def open_pack(self, size):
+        """Return a pack file, open for appending, with room for size bytes."""
+        if self.pack_file is not None and self.pack_file.tell() + size <= MAX_PACK_SIZE:
+            return self.pack_file
+
+        if self.pack_file is not None:
+            self.pack_file.close()
+            self.pack_file = None
+
+        names = self.get_pack_names()
+        if len(names) > 0 and os.path.getsize(os.path.join(self.path, names[-1])) + size <= MAX_PACK_SIZE:
+            self.pack_name = names[-1]
+        else:
+            self.pack_name = '%s%06d' % (PACK_PREFIX, len(names))
+        self.pack_file = open(os.path.join(self.path, self.pack_name), 'ab')
+        self.pack_file.seek(0, os.SEEK_END)
+        return self.pack_file
+
+    def contains(self, key):
+        return key in self.index
+
+    def add(self, key, bufs):
+        """Store the contents given by the list of buffers under key, unless
+        they are already stored.  Returns True if they were added."""
+        if key in self.index:
+            return False
+
+        size = sum(len(buf) for buf in bufs)
+        f = self.open_pack(size)
+        offset = f.tell()
+        for buf in bufs:
+            f.write(buf)
+        self.index[key] = self.pack_name, offset, size
+        return True
+
+    def read(self, key):
+        """Read the contents stored under key, via a memory map of its pack."""
+        pack_name, offset, size = self.index[key]
+        if size == 0:
+            return ''
+
+        if pack_name == self.pack_name:
+            self.pack_file.flush()
+
+        f = open(os.path.join(self.path, pack_name), 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return m[offset:offset+size]
+            finally:
+                m.close()
+        finally:
+            f.close()
+
+    def load_catalog(self, name):
+        f = open(os.path.join(self.path, name + CATALOG_SUFFIX), 'rb')
+        catalog = cPickle.load(f)
+        f.close()
+        return catalog
+
+    def save_catalog(self, name, catalog):
+        f = open(os.path.join(self.path, name + CATALOG_SUFFIX), 'wb')
+        cPickle.dump(catalog, f)
+        f.close()
+
+    def extract(self, catalog, item_path, dest_path):
+        f = open(dest_path, 'wb')
+        f.write(self.read(catalog[item_path]))
+        f.close()
+
+
+def list_dir(catalog, dir_path):
+    """Return the names of the packed items directly inside dir_path."""
+    dir_path = os.path.normpath(dir_path)
+    names = []
+    for item_path in catalog:
+        parent, name = os.path.split(os.path.normpath(item_path))
+        if parent == dir_path or (parent == '' and dir_path == '.'):
+            names.append(name)
+    names.sort()
+    return names
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    target = argv[1]
+    name = argv[2]
+
+    store = PackStore(target)
+    store.open()
+    catalog = store.load_catalog(name)
+
+    if len(argv) <= 3:
+        for item_path in sorted(catalog):
+            print item_path
+        return
+
+    item_path = os.path.normpath(argv[3])
+    if len(argv) <= 4:
+        for fn in list_dir(catalog, item_path):
+            print fn
+        return
+
+    store.extract(catalog, item_path, argv[4])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Sparse file support.
+
+The holes in a sparse file (e.g. a VM image or a preallocated database)
+read as zeros but take no space.  Reading them anyway costs time, and
+writing the zeros out makes the copy take as much space as the file's
+full size.  Where the OS supports SEEK_DATA and SEEK_HOLE, a file's data
+extents are found without reading it; the holes are then hashed as zeros
+without being read, and recreated as holes in the copy.  The hash is the
+same as if every byte had been read.
+
+Where SEEK_DATA is not supported (e.g. Windows), files are treated as
+dense.
+"""
+
+import os
+import errno
+
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+ZERO_BUFFER_SIZE = 1024*1024
+ZERO_BUFFER = '\0' * ZERO_BUFFER_SIZE
+
+
+def get_extents(path):
+    """Return the data extents of the file, as a list of (start, end)
+    pairs, or None if it has no holes (or they can't be found)."""
+    st = os.stat(path)
+    if getattr(st, 'st_blocks', None) is None or st.st_blocks * 512 >= st.st_size:
+        return None
+
+    extents = []
+    fd = os.open(path, os.O_RDONLY | O_BINARY)
+    try:
+        pos = 0
+        while pos < st.st_size:
+            try:
+                start = os.lseek(fd, pos, SEEK_DATA)
+            except OSError, ex:
+                if ex.errno == errno.ENXIO:
+                    break
+                if ex.errno == errno.EINVAL:
+                    return None
+                raise
+            end = min(os.lseek(fd, start, SEEK_HOLE), st.st_size)
+            if start >= end:
+                break
+            extents.append((start, end))
+            pos = end
+    finally:
+        os.close(fd)
+
+    if extents == [(0, st.st_size)]:
+        return None
+    return extents
+
+
+class SparseReader(object):
+    """Reads a file as an ordinary file would, but gives zeros for the
+    holes between its data extents without reading them."""
+
+    def __init__(self, f, extents, size):
+        self.file = f
+        self.extents = extents
+        self.size = size
+        self.index = 0
+        self.pos = 0
+        self.file_pos = 0
+
+    def read(self, size):
+        while self.index < len(self.extents) and self.extents[self.index][1] <= self.pos:
+            self.index += 1
+        if self.index < len(self.extents):
+            start, end = self.extents[self.index]
+        else:
+            start = end = self.size
+
+        if self.pos < start:
+            n = min(size, start - self.pos, ZERO_BUFFER_SIZE)
+            self.pos += n
+            if n == ZERO_BUFFER_SIZE:
+                return ZERO_BUFFER
+            return ZERO_BUFFER[:n]
+
+        n = min(size, end - self.pos)
+        if n <= 0:
+            return ''
+        if self.file_pos != self.pos:
+            self.file.seek(self.pos)
+        buf = self.file.read(n)
+        self.pos += len(buf)
+        self.file_pos = self.pos
+        return buf
+
+    def close(self):
+        self.file.close()
+
+
+def copy_extents(f, f2, extents, size, buffer_size):
+    """Copy just the data extents from f to f2, leaving holes in f2."""
+    for start, end in extents:
+        f.seek(start)
+        f2.seek(start)
+        pos = start
+        while pos < end:
+            buf = f.read(min(buffer_size, end - pos))
+            if len(buf) == 0:
+                break
+            f2.write(buf)
+            pos += len(buf)
+    f2.truncate(size)
@@ -0,0 +1,52 @@
+import backup
+import cacheio
+import os
+import sys
+import time
+
+def read_cached_kb():
+    f = open('/proc/meminfo', 'rt')
+    for line in f:
+        if line.startswith('Cached:'):
+            f.close()
+            return int(line.split()[1])
+    f.close()
+    return 0
+
+def drop_cached(path):
+    if not cacheio.is_available():
+        return
+    fd = os.open(path, os.O_RDONLY)
+    cacheio.posix_fadvise(fd, 0, 0, cacheio.POSIX_FADV_DONTNEED)
+    os.close(fd)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    path = argv[1]
+
+    modes = [('normal', False, None), ('neutral', True, None), ('direct', True, 0)]
+    for mode, cache_neutral, direct_min_size in modes:
+        if cache_neutral and not cacheio.is_available():
+            continue
+        saved_min_size = cacheio.DIRECT_MIN_SIZE
+        if direct_min_size is not None:
+            cacheio.DIRECT_MIN_SIZE = direct_min_size
+
+        drop_cached(path)
+        b = backup.Backup()
+        b.cache_neutral = cache_neutral
+        cached_before = read_cached_kb()
+        start_time = time.time()
+        digests, total, big_buf = b.get_hash(path)
+        stop_time = time.time()
+        cached_after = read_cached_kb()
+        cacheio.DIRECT_MIN_SIZE = saved_min_size
+
+        elapsed = stop_time - start_time
+        print mode, elapsed, total / elapsed / 1048576, cached_after - cached_before
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import backup
+import hashlib
+import links
+import os
+import shutil
+import sys
+import tempfile
+
+BLOCK = backup.DELTA_BLOCK_SIZE
+
+class QuietNotifier(object):
+    def notice(self, msg):
+        pass
+    def warning(self, msg):
+        pass
+    def error(self, msg, ex=None):
+        print msg, ex
+
+def write_blocks(path, letters):
+    f = open(path, 'wb')
+    for c in letters:
+        f.write(c * BLOCK)
+    f.close()
+
+def file_md5(path):
+    f = open(path, 'rb')
+    digest = hashlib.md5(f.read()).hexdigest()
+    f.close()
+    return digest
+
+def run(source, target, name, delta):
+    b = backup.Backup()
+    b.notifier = QuietNotifier()
+    b.source = source
+    b.target = target
+    b.name = name
+    if delta:
+        b.delta_min_size = BLOCK
+    b.run()
+
+def check(source, target, name, label):
+    same = file_md5(os.path.join(source, 'vm.img')) == file_md5(os.path.join(target, name, 'vm.img'))
+    print label, same
+    assert same
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    # Reflinks aren't available everywhere, so clone by copying.
+    links.reflink = shutil.copyfile
+
+    base = tempfile.mkdtemp()
+    source = os.path.join(base, 'src')
+    target = os.path.join(base, 'dst')
+    os.mkdir(source)
+    os.mkdir(target)
+    path = os.path.join(source, 'vm.img')
+
+    write_blocks(path, 'aaa')
+    run(source, target, 'r1', True)
+    check(source, target, 'r1', 'initial')
+
+    write_blocks(path, 'aba')
+    run(source, target, 'r2', True)
+    check(source, target, 'r2', 'delta')
+
+    # A run without block hashes leaves the stored ones stale.
+    write_blocks(path, 'bbb')
+    run(source, target, 'r3', False)
+    check(source, target, 'r3', 'no-delta')
+
+    write_blocks(path, 'aca')
+    run(source, target, 'r4', True)
+    check(source, target, 'r4', 'stale-hashes')
+
+    shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
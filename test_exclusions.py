@@ -0,0 +1,84 @@
+import exclusions
+import os
+import shutil
+import sys
+import tempfile
+
+def check(label, result, expected):
+    print label, result
+    assert result == expected, (label, result, expected)
+
+def rule(line):
+    e = exclusions.Exclusions()
+    e.add(line)
+    r = e.rules[0]
+    return r.kind, r.limit, r.pattern
+
+def check_rules():
+    check('size', rule('size > 4G'), ('size', 4 * 1024**3, ''))
+    check('size-pattern', rule('size>4G *.iso'), ('size', 4 * 1024**3, '*.iso'))
+    check('size-no-unit', rule('size > 100 tmp.bin'), ('size', 100, 'tmp.bin'))
+    check('size-no-unit-f', rule('size > 100 foo.log'), ('size', 100, 'foo.log'))
+    check('age', rule('age > 365d *.log'), ('age', 365 * 86400, '*.log'))
+    check('age-no-unit', rule('age > 30 data.log'), ('age', 30 * 86400, 'data.log'))
+    try:
+        rule('size > 10X foo')
+        check('bad-unit', None, ValueError)
+    except ValueError:
+        check('bad-unit', ValueError, ValueError)
+
+def check_patterns(source):
+    e = exclusions.Exclusions()
+    for line in ['/build', 'windows/temp', '*.tmp', '**/node_modules/', 'cache/**', '__pycache__/', 'size > 100 big.bin']:
+        e.add(line)
+    e.compile()
+
+    os.makedirs(os.path.join(source, 'src', 'node_modules'))
+    os.makedirs(os.path.join(source, 'src', '__pycache__'))
+    f = open(os.path.join(source, '__pycache__'), 'wb')
+    f.close()
+    f = open(os.path.join(source, 'big.bin'), 'wb')
+    f.write('x' * 200)
+    f.close()
+    f = open(os.path.join(source, 'small.bin'), 'wb')
+    f.close()
+
+    def matches(item_path):
+        return e.matches(item_path, os.path.join(source, item_path))
+
+    check('anchored-exact', matches('build'), True)
+    check('anchored-exact-deeper', matches('src/build'), False)
+    check('exact', matches('windows/temp'), True)
+    check('name-glob', matches('a/b/c.tmp'), True)
+    check('name-glob-other', matches('a/b/c.txt'), False)
+    check('dir-pattern', matches('src/node_modules'), True)
+    check('dir-name', matches('src/__pycache__'), True)
+    check('dir-name-file', matches('__pycache__'), False)
+    check('path-glob', matches('cache/x/y'), True)
+    check('size-rule', matches('big.bin'), True)
+    check('size-rule-small', matches('small.bin'), False)
+
+def check_read(base):
+    filename = os.path.join(base, 'exclusions')
+    f = open(filename, 'wt')
+    f.write('# comment\n*.tmp\nsize > 10X foo\n/build\n')
+    f.close()
+    errors = []
+    e = exclusions.read_exclusions(filename, errors)
+    check('read-skips-bad', (len(e), len(errors)), (2, 1))
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    base = tempfile.mkdtemp()
+    try:
+        check_rules()
+        check_patterns(os.path.join(base, 'source'))
+        check_read(base)
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import cPickle
+import fakevolume
+import journal
+import os
+import random
+import sys
+import tempfile
+import time
+
+def build_volume(num_dirs, files_per_dir):
+    vol = fakevolume.SyntheticVolume()
+    dirs = [fakevolume.ROOT_FRN]
+    files = []
+    for i in range(num_dirs):
+        dirs.append(vol.create(random.choice(dirs), u'dir%d' % i, is_dir=True))
+        for j in range(files_per_dir):
+            files.append(vol.create(dirs[-1], u'file%d.txt' % j))
+    return vol, dirs, files
+
+def run(j, vol, label):
+    start_time = time.time()
+    j.process()
+    stop_time = time.time()
+    changed = len(j.changed) + len(j.changed_dirs)
+    print label, stop_time - start_time, j.everything_changed, changed, len(j.frn_to_dir_map)
+
+def check_torn_log():
+    """A batch cut short in the dir map's log is dropped, and later batches
+    can still be read."""
+    filename = os.path.join(tempfile.mkdtemp(), 'frnmap')
+    m = journal.FrnMap()
+    for i in range(100):
+        m.set(i, 0, u'd%d' % i)
+    m.save(filename)
+    batch = cPickle.dumps([(20, 0, u'x20')], cPickle.HIGHEST_PROTOCOL)
+    f = open(filename + journal.LOG_SUFFIX, 'ab')
+    f.write(batch[:len(batch) // 2])
+    f.close()
+
+    m = journal.FrnMap()
+    m.load(filename)
+    assert m.get(20) == (0, u'd20')
+    m.set(25, 0, u'f25')
+    m.save_changes(filename)
+    m = journal.FrnMap()
+    m.load(filename)
+    assert m.get(25) == (0, u'f25')
+    print 'torn-log', True
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    num_dirs = 10000
+    files_per_dir = 10
+    num_changes = 1000
+    if len(argv) > 1:
+        num_dirs = int(argv[1])
+
+    random.seed(0)
+    vol, dirs, files = build_volume(num_dirs, files_per_dir)
+    j = journal.Journal('X:')
+    j.open_volume = lambda drive: vol
+
+    run(j, vol, 'initial')
+    run(j, vol, 'unchanged')
+
+    changed = random.sample(files, num_changes)
+    for frn in changed:
+        vol.write(frn)
+    run(j, vol, 'incremental')
+    path = j.frn_to_dir_map.build_path(vol.files[changed[0]][0]) + '/' + vol.files[changed[0]][1]
+    assert j.affected(path)
+
+    vol.write(changed[0])
+    old_usn = j.last_usn
+    vol.truncate_journal()
+    assert list(journal.generate_journal(vol, j.journal_id, old_usn)) == []
+    run(j, vol, 'truncated')
+    assert j.everything_changed
+
+    vol.reset_journal()
+    run(j, vol, 'new-journal')
+    assert j.everything_changed
+
+    vol.deactivate_journal()
+    run(j, vol, 'inactive')
+    assert j.everything_changed
+
+    for frn in changed:
+        vol.write(frn)
+    state = j.journal_id, j.last_usn, dict(j.frn_to_dir_map.items())
+    capture_filename = os.path.join(tempfile.mkdtemp(), 'capture')
+    j.open_volume = lambda drive: fakevolume.CapturingVolume(vol, capture_filename)
+    run(j, vol, 'captured')
+    captured_paths = j.get_changed_paths()
+
+    j2 = journal.Journal('X:')
+    j2.set_state(state)
+    j2.open_volume = lambda drive: fakevolume.ReplayVolume(capture_filename)
+    run(j2, vol, 'replayed')
+    assert j2.get_changed_paths() == captured_paths
+
+    check_torn_log()
+
+
+if __name__ == '__main__':
+    main()